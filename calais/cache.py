@@ -0,0 +1,107 @@
+"""
+Cache module to store responses from the OpenAI API on disk so that repeated
+conversations don't need another API call.
+"""
+
+from __future__ import annotations
+import hashlib
+import json
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Iterable, Optional
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+from calais.response import Response
+
+# The number of responses to keep. The least recently used responses beyond
+# this are evicted.
+MAX_ENTRIES = 10_000
+# How long a response is kept, in seconds, so stale answers aren't reused
+# forever.
+MAX_AGE = 7 * 24 * 60 * 60
+
+
+def conversation_key(
+    model: str, temperature: float, conversation: Iterable[ChatCompletionMessageParam]
+) -> str:
+    """Return a hash of the conversation and the model parameters."""
+    messages = [
+        {"role": message["role"], "content": message.get("content")}
+        for message in conversation
+    ]
+    data = json.dumps(
+        [model, temperature, messages],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.blake2b(data.encode("utf-8"), digest_size=32).hexdigest()
+
+
+class ResponseCache:
+    """
+    An on-disk LRU cache of responses, keyed on a hash of the conversation
+    that produced them and the model parameters used. Responses expire
+    max_age seconds after they were stored.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model: str,
+        temperature: float,
+        max_entries: int = MAX_ENTRIES,
+        max_age: float = MAX_AGE,
+    ) -> None:
+        self.model: str = model
+        self.temperature: float = temperature
+        self.max_entries: int = max_entries
+        self.max_age: float = max_age
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+            "response TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self.connection.commit()
+
+    def key(self, conversation: Iterable[ChatCompletionMessageParam]) -> str:
+        """Return the cache key for the conversation."""
+        return conversation_key(self.model, self.temperature, conversation)
+
+    def get(self, key: str) -> Optional[Response]:
+        """Return the cached response for the key, or None if there isn't one."""
+        now = time.time()
+        row = self.connection.execute(
+            "SELECT response, created FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self.max_age:
+            self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.connection.commit()
+            return None
+        self.connection.execute(
+            "UPDATE responses SET accessed = ? WHERE key = ?", (now, key)
+        )
+        self.connection.commit()
+        return Response.from_json(row[0])
+
+    def set(self, key: str, response: Response) -> None:
+        """Store the response under the key, evicting the oldest if full."""
+        now = time.time()
+        self.connection.execute(
+            "INSERT OR REPLACE INTO responses (key, response, created, accessed) "
+            "VALUES (?, ?, ?, ?)",
+            (key, response.to_json(), now, now),
+        )
+        self.connection.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY accessed DESC LIMIT ?)",
+            (self.max_entries,),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Close the connection to the cache database."""
+        self.connection.close()
@@ -1,29 +1,38 @@
 """
 Chat module to interact with the OpenAI API.
+
+The openai package takes a large part of the CLI's startup time to import, so
+it's only imported for type checking here and otherwise imported when it is
+first needed to call the API.
 """
 
+from __future__ import annotations
 import time
-import os
-import concurrent.futures
+import random
+from dataclasses import dataclass
 from enum import Enum
 
-from typing import Any, Iterable, List
-from openai import OpenAIError, Stream
-from openai.types.chat import (
-    ChatCompletion,
-    ChatCompletionChunk,
-    ChatCompletionMessageParam,
-    ChatCompletionSystemMessageParam,
-    ChatCompletionUserMessageParam,
-    ChatCompletionAssistantMessageParam,
-)
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, List, Optional, cast
+
+if TYPE_CHECKING:
+    from openai import RateLimitError, Stream
+    from openai.types.chat import (
+        ChatCompletion,
+        ChatCompletionChunk,
+        ChatCompletionMessageParam,
+    )
 
+from calais.cache import ResponseCache
 from calais.client import IOpenAIClient
+from calais.semantic_cache import SemanticCache
 from calais.response import Response
 from calais.content_printer import ContentPrinter
 
-CONTENTS_START_MARKER = '"contents": "'
-CONTENTS_END_MARKER = '",\n'
+# The longest time to wait between retries, in seconds.
+MAX_RETRY_DELAY = 60
+# The most characters of response to accept, so that a runaway generation
+# can't exhaust memory.
+MAX_RESPONSE_CHARS = 10 * 1024 * 1024
 
 
 class Role(Enum):
@@ -42,46 +51,100 @@ class ChatError(Exception):
         super().__init__(self.message)
 
 
+def _make_message(role: Role, content: str) -> ChatCompletionMessageParam:
+    """Return a message with the given role and content."""
+    if not isinstance(role, Role):
+        raise ChatError(f"Invalid role: {role}")
+    return cast("ChatCompletionMessageParam", {"role": role.value, "content": content})
+
+
+def _retry_after(error: RateLimitError) -> Optional[float]:
+    """
+    Return the delay requested by the Retry-After header, if any, capped at
+    MAX_RETRY_DELAY so that a large value can't block the CLI.
+    """
+    try:
+        delay = float(error.response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+    if not delay >= 0:  # Also rejects NaN.
+        return None
+    return min(delay, MAX_RETRY_DELAY)
+
+
+@dataclass(frozen=True, slots=True)
+class ChatConfig:
+    """Settings for a Chat. Times are in seconds."""
+
+    retries: int
+    timeout: int
+    retry_delay: int
+    max_empty_chunks: int
+    history_window: Optional[int] = None
+    max_response_chars: int = MAX_RESPONSE_CHARS
+
+
 class Chat:
     """A class to interact with the OpenAI API and manage a conversation."""
 
     def __init__(
         self,
         client: IOpenAIClient,
-        retries: int,
-        timeout: int,
-        retry_delay: int,
-        max_empty_chunks: int,
+        config: ChatConfig,
+        cache: Optional[ResponseCache] = None,
+        semantic_cache: Optional[SemanticCache] = None,
     ) -> None:
         self.client: IOpenAIClient = client
-        self.max_retries: int = retries
-        self.timeout: int = timeout
-        self.retry_delay: int = retry_delay
-        self.max_empty_chunks: int = max_empty_chunks
+        self.config: ChatConfig = config
         self.conversation: List[ChatCompletionMessageParam] = []
+        self.cache: Optional[ResponseCache] = cache
+        self.semantic_cache: Optional[SemanticCache] = semantic_cache
 
     def add_to_conversation(self, role: Role, content: str) -> None:
         """Add a message with a given role to the conversation."""
-        msg: ChatCompletionMessageParam
-        match role:
-            case Role.SYSTEM:
-                msg = ChatCompletionSystemMessageParam(content=content, role="system")
-            case Role.ASSISTANT:
-                msg = ChatCompletionAssistantMessageParam(
-                    content=content, role="assistant"
-                )
-            case Role.USER:
-                msg = ChatCompletionUserMessageParam(content=content, role="user")
-            case _:
-                raise ChatError(f"Invalid role: {role}")
-        self.conversation.append(msg)
+        self.conversation.append(_make_message(role, content))
+
+    def add_messages(self, messages: Iterable[tuple[Role, str]]) -> None:
+        """
+        Add several (role, content) messages to the conversation at once. If
+        any role is invalid, none of the messages are added.
+        """
+        self.conversation.extend(
+            [_make_message(role, content) for role, content in messages]
+        )
+
+    def _messages_to_send(self) -> List[ChatCompletionMessageParam]:
+        """
+        Return the messages to send for the next turn: the leading system
+        messages, then the rest of the conversation, or just its most recent
+        messages if it's longer than the history window.
+
+        Old messages are dropped half a window at a time rather than one turn
+        at a time, so that the messages sent keep the same prefix for several
+        turns and OpenAI's prompt cache can still hit. Messages are never
+        reordered.
+        """
+        system_count = 0
+        while (
+            system_count < len(self.conversation)
+            and self.conversation[system_count]["role"] == Role.SYSTEM.value
+        ):
+            system_count += 1
+        history = self.conversation[system_count:]
+        window = self.config.history_window
+        if window is None or len(history) <= window:
+            return self.conversation
+        step = max(1, window // 2)
+        excess = len(history) - window
+        dropped = -(-excess // step) * step  # Round up to a whole step.
+        return self.conversation[:system_count] + history[dropped:]
 
     def _call_api(
         self,
         messages: Iterable[ChatCompletionMessageParam],
     ) -> ChatCompletion | Stream[ChatCompletionChunk]:
         """Call the OpenAI API to generate a response."""
-        resp = self.client.call_api(messages)
+        resp = self.client.call_api(messages, timeout=self.config.timeout)
         return resp
 
     def _process_response_chunk(self, chunk: ChatCompletionChunk) -> tuple[str, bool]:
@@ -95,19 +158,18 @@ class Chat:
         is a non-None finish_reason.
         https://platform.openai.com/docs/guides/text-generation/completions-api
         """
-        content = chunk.choices[0].delta.content
-        if content is None:
-            content = ""
-        match (reason := chunk.choices[0].finish_reason):
+        choice = chunk.choices[0]
+        content = choice.delta.content or ""
+        reason = choice.finish_reason
+        if reason is None:  # Nearly every chunk, so check it first.
+            return content, False
+        match reason:
             case "length":
                 raise ChatError("stopped because max_tokens reached")
             case "stop":
                 return content, True  # Signal to stop processing.
-            case None:
-                pass  # Do nothing, continue processing.
             case _:
                 raise ChatError(f"unexpected completion reason: {reason}")
-        return content, False
 
     def _check_returned_chunk(
         self, chunk: tuple[str, Any] | ChatCompletionChunk
@@ -116,6 +178,9 @@ class Chat:
         Check if chunk is of expected ChatCompletionChunk type. Return
         the chunk as a ChatCompletionChunk else raise an error.
         """
+        # pylint: disable-next=import-outside-toplevel
+        from openai.types.chat import ChatCompletionChunk
+
         if isinstance(chunk, ChatCompletionChunk):
             return chunk
         elif isinstance(chunk, tuple) and len(chunk) == 2:
@@ -127,6 +192,44 @@ class Chat:
         else:
             raise ChatError(f"Received an unexpected chunk type: {type(chunk)}")
 
+    def _stream_chunk_texts(
+        self, messages: Iterable[ChatCompletionMessageParam]
+    ) -> Iterator[str]:
+        """
+        Call the API and yield the text of each response chunk as it arrives,
+        stopping after the chunk with the "stop" finish reason. The response
+        stream is closed when the generator finishes. Raise a ChatError if the
+        response grows beyond the configured max_response_chars.
+
+        A stalled stream is bounded by the client, which applies the configured
+        timeout to the connection and each network read.
+        """
+        response = self._call_api(messages)
+        try:
+            response_chars = 0
+            checked = False
+            for chunk in response:
+                if not checked:
+                    # The chunks of a stream all have the same type, so only
+                    # the first one needs checking.
+                    chunk = self._check_returned_chunk(chunk)
+                    checked = True
+                chunk_text, stop = self._process_response_chunk(chunk)
+                response_chars += len(chunk_text)
+                if response_chars > self.config.max_response_chars:
+                    raise ChatError(
+                        f"response exceeded {self.config.max_response_chars} characters"
+                    )
+                yield chunk_text
+                if stop:  # Stop condition met.
+                    return
+        finally:
+            # Release the connection now, even if the stream wasn't read to
+            # the end, rather than when the stream is garbage collected.
+            close = getattr(response, "close", None)
+            if close is not None:
+                close()
+
     def _call_gpt_api(
         self,
         messages: Iterable[ChatCompletionMessageParam],
@@ -137,62 +240,155 @@ class Chat:
         response text and the number of empty chunks.
 
         If print_chunks is True, print each chunk immediately as it is
-        received.
+        received, so the printing overlaps with the generation of the rest
+        of the response.
         """
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self._call_api, messages)
-            response = future.result(timeout=self.timeout)
-
         content_printer = ContentPrinter()
-        text: str = ""
+        parts: List[str] = []
         empty_chunk_count: int = 0
-        for chunk in response:
-            chunk = self._check_returned_chunk(chunk)
-            chunk_text, stop = self._process_response_chunk(chunk)
-            text += chunk_text
-            if print_chunks:
-                content_printer.print_chunk(chunk_text)
-            if not chunk_text.strip():  # Empty or whitespace only.
+        for chunk_text in self._stream_chunk_texts(messages):
+            if chunk_text:
+                parts.append(chunk_text)
+                if print_chunks:
+                    content_printer.print_chunk(chunk_text)
+            if not chunk_text or chunk_text.isspace():  # Empty or whitespace only.
                 empty_chunk_count += 1
-            if stop:  # Stop condition met.
-                break
 
         content_printer.finish()
-        return text, empty_chunk_count
+        return "".join(parts), empty_chunk_count
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        Return the delay before retrying after the given attempt, starting at
+        the configured retry_delay and doubling each attempt up to
+        MAX_RETRY_DELAY. The delay is jittered by +/-50% so that clients don't
+        retry in lockstep.
+        """
+        delay = min(self.config.retry_delay * 2**attempt, MAX_RETRY_DELAY)
+        return delay * (0.5 + random.random())
 
-    def _handle_retry(self, message: str) -> None:
-        """Handle retry logic and messaging."""
+    def _handle_retry(
+        self, message: str, attempt: int, delay: Optional[float] = None
+    ) -> None:
+        """
+        Handle retry logic and messaging. Wait for the given delay, or back off
+        based on the attempt number if there isn't one.
+        """
         print(message)
-        time.sleep(self.retry_delay)
+        if delay is None:
+            delay = self._backoff_delay(attempt)
+        time.sleep(delay)
 
     def _generate_response(
         self, messages: Iterable[ChatCompletionMessageParam], print_chunks: bool
     ) -> Response:
         """
-        Generate a response from the OpenAI API. Retry on failure up to
-        self.max_retries.
+        Generate a response from the OpenAI API. Retry on failure up to the
+        configured number of retries.
         """
+        # pylint: disable-next=import-outside-toplevel
+        from openai import APITimeoutError, OpenAIError, RateLimitError
+
         retries = 0
-        while retries <= self.max_retries:
+        timed_out = False
+        while retries <= self.config.retries:
             try:
                 text, empty_chunk_count = self._call_gpt_api(messages, print_chunks)
-                if empty_chunk_count > self.max_empty_chunks:
-                    self._handle_retry("Received too many empty chunks. Retrying...")
+                if empty_chunk_count > self.config.max_empty_chunks:
+                    self._handle_retry(
+                        "Received too many empty chunks. Retrying...", retries
+                    )
                 else:
                     try:
                         # Now that we have a complete response, we can parse
                         # the JSON and return it as a Response object.
                         return Response.from_json(text)
                     except ValueError as e:
-                        self._handle_retry(f"Error occurred. Retrying... ({e})")
+                        self._handle_retry(
+                            f"Error occurred. Retrying... ({e})", retries
+                        )
 
-            except (OpenAIError, concurrent.futures.TimeoutError) as e:
-                self._handle_retry(f"Error occurred. Retrying... ({e})")
+            except RateLimitError as e:
+                self._handle_retry(
+                    f"Rate limited. Retrying... ({e})", retries, _retry_after(e)
+                )
+            except APITimeoutError as e:
+                # A single timeout is often transient, so retry it at once.
+                self._handle_retry(
+                    f"Timed out. Retrying... ({e})",
+                    retries,
+                    None if timed_out else 0,
+                )
+                timed_out = True
+            except OpenAIError as e:
+                self._handle_retry(f"Error occurred. Retrying... ({e})", retries)
             retries += 1
 
         raise ChatError("Failed to receive a response from OpenAI.")
 
+    def _cached_response(
+        self, messages: List[ChatCompletionMessageParam], prompt: str
+    ) -> Optional[Response]:
+        """
+        Return the cached response to the conversation, or to a similar
+        prompt after the same earlier conversation, if there is one.
+        """
+        if self.cache is not None:
+            response = self.cache.get(self.cache.key(messages))
+            if response is not None:
+                return response
+        if self.semantic_cache is not None:
+            # pylint: disable-next=import-outside-toplevel
+            from openai import OpenAIError
+
+            try:
+                match = self.semantic_cache.get(messages[:-1], prompt)
+            except OpenAIError:
+                # Embedding the prompt failed. The cache is only a shortcut,
+                # so treat it as a miss and ask GPT-4.
+                return None
+            if match is not None:
+                similar, response = match
+                if response.command is not None:
+                    # Similar prompts can still differ in a file name or
+                    # path, so make sure the user can check the command.
+                    print(f'Reused the command from the similar prompt "{similar}".')
+                return response
+        return None
+
+    def _cache_response(
+        self,
+        messages: List[ChatCompletionMessageParam],
+        prompt: str,
+        response: Response,
+    ) -> None:
+        """Add the response to the conversation to the caches."""
+        if self.cache is not None:
+            self.cache.set(self.cache.key(messages), response)
+        if self.semantic_cache is not None:
+            # pylint: disable-next=import-outside-toplevel
+            from openai import OpenAIError
+
+            try:
+                self.semantic_cache.set(messages[:-1], prompt, response)
+            except OpenAIError:
+                pass  # The response just isn't cached.
+
     def call_gpt4(self, prompt: str, print_chunks: bool) -> Response:
-        """Call the OpenAI API and accumulate the response chunks."""
+        """
+        Call the OpenAI API and accumulate the response chunks. If there is a
+        cache, a response to the same conversation, or to a similar prompt, is
+        returned from it instead, and new responses without errors are added
+        to it.
+        """
         self.add_to_conversation(Role.USER, prompt)
-        return self._generate_response(self.conversation, print_chunks)
+        messages = self._messages_to_send()
+        response = self._cached_response(messages, prompt)
+        if response is not None:
+            if print_chunks and response.content:
+                print(response.content)
+            return response
+        response = self._generate_response(messages, print_chunks)
+        if not response.error:
+            self._cache_response(messages, prompt, response)
+        return response
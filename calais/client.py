@@ -3,14 +3,16 @@ The Client module contains the IOpenAIClient interface, including real and test
 implementations.
 """
 
-from typing import Iterable, Protocol
-from openai import OpenAI, Stream
-from openai.types.chat.completion_create_params import ResponseFormat
-from openai.types.chat import (
-    ChatCompletion,
-    ChatCompletionChunk,
-    ChatCompletionMessageParam,
-)
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterable, List, Optional, Protocol
+
+if TYPE_CHECKING:
+    from openai import OpenAI, Stream
+    from openai.types.chat import (
+        ChatCompletion,
+        ChatCompletionChunk,
+        ChatCompletionMessageParam,
+    )
 
 # The model to use for chat completions. Note that to return JSON, the
 # model must be "gpt-4-turbo-preview" or "gpt-3.5-turbo-0125"
@@ -18,6 +20,8 @@ from openai.types.chat import (
 # Another current valid model is "gpt-4", but it rejects the response_format
 # parameter.
 MODEL = "gpt-4-turbo-preview"
+# The model used to embed prompts for the semantic cache.
+EMBEDDING_MODEL = "text-embedding-3-small"
 
 
 class IOpenAIClient(Protocol):
@@ -29,29 +33,82 @@ class IOpenAIClient(Protocol):
     def call_api(
         self,
         messages: Iterable[ChatCompletionMessageParam],
+        timeout: float,
     ) -> ChatCompletion | Stream[ChatCompletionChunk]:
-        """Call the OpenAI API with the given messages."""
+        """
+        Call the OpenAI API with the given messages. The timeout, in seconds,
+        bounds the connection and each read of the response.
+        """
 
 
 class OpenAIClient(IOpenAIClient):
-    """This is the real implementation of the IOpenAIClient interface."""
+    """
+    This is the real implementation of the IOpenAIClient interface.
+
+    The underlying OpenAI client keeps a pool of HTTP connections alive
+    between requests, so create one OpenAIClient per process and reuse it for
+    every turn of the conversation to avoid a new TLS handshake per request.
+    The OpenAI client, and the openai package, are only loaded on first use.
+    """
 
-    def __init__(self, api_key: str, model: str, max_tokens: int, temperature: float):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(
+        self,
+        api_key: str,
+        model: str,
+        max_tokens: int,
+        temperature: float,
+        prompt_cache_key: Optional[str] = None,
+    ):
+        self.api_key: str = api_key
+        self._client: Optional[OpenAI] = None
         self.model: str = model
         self.max_tokens: int = max_tokens
         self.temperature: float = temperature
+        # Requests with the same key and a common prefix are routed so that
+        # OpenAI's server-side prompt cache is more likely to hit.
+        self.prompt_cache_key: Optional[str] = prompt_cache_key
+
+    @property
+    def client(self) -> OpenAI:
+        """The OpenAI client, created on first use."""
+        if self._client is None:
+            # pylint: disable-next=import-outside-toplevel
+            from openai import OpenAI
+
+            self._client = OpenAI(api_key=self.api_key)
+        return self._client
 
     def call_api(
         self,
         messages: Iterable[ChatCompletionMessageParam],
+        timeout: float,
     ) -> ChatCompletion | Stream[ChatCompletionChunk]:
         """Call the streaming OpenAI API with the given messages."""
+        # pylint: disable-next=import-outside-toplevel
+        from openai import NOT_GIVEN
+
         return self.client.chat.completions.create(
             model=MODEL,
-            response_format=ResponseFormat({"type": "json_object"}),
+            response_format={"type": "json_object"},
             messages=messages,
             max_tokens=self.max_tokens,
             temperature=self.temperature,
             stream=True,
+            prompt_cache_key=self.prompt_cache_key or NOT_GIVEN,
+            timeout=timeout,
         )
+
+    def embed(self, text: str, timeout: float) -> List[float]:
+        """
+        Return the embedding of the text. The timeout, in seconds, bounds the
+        connection and each read of the response.
+        """
+        response = self.client.embeddings.create(
+            model=EMBEDDING_MODEL, input=text, timeout=timeout
+        )
+        return response.data[0].embedding
+
+    def close(self) -> None:
+        """Close the pooled HTTP connections, if any were opened."""
+        if self._client is not None:
+            self._client.close()
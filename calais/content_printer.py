@@ -1,9 +1,129 @@
 """Module for ContentPrinter class."""
 
 import codecs
+import sys
+import time
+from json.decoder import scanstring
+from typing import List
 
 CONTENTS_START_MARKER = '"content": "'
 CONTENTS_END_MARKER = '",'
+# The longest JSON escape sequence, \uXXXX.
+MAX_ESCAPE_LENGTH = 6
+# The starts of the \uXXXX escapes for the first half of a surrogate pair.
+HIGH_SURROGATE_PREFIXES = ("d8", "d9", "da", "db")
+# Printed text is flushed to the terminal once this many characters are
+# waiting or this many seconds have passed, rather than on every chunk.
+FLUSH_SIZE = 64
+FLUSH_INTERVAL = 0.05
+
+
+def _failure_table(marker: str) -> List[int]:
+    """
+    Build the Knuth-Morris-Pratt failure table for the marker. Entry i is the
+    length of the longest proper prefix of marker[: i + 1] that is also its
+    suffix.
+    """
+    table = [0] * len(marker)
+    length = 0
+    for i in range(1, len(marker)):
+        while length and marker[i] != marker[length]:
+            length = table[length - 1]
+        if marker[i] == marker[length]:
+            length += 1
+        table[i] = length
+    return table
+
+
+_END_MARKER_FAILURE = _failure_table(CONTENTS_END_MARKER)
+
+
+def _partial_marker_length(text: str, marker: str, failure: List[int]) -> int:
+    """
+    Return the length of the longest proper prefix of marker that text ends
+    with, i.e. how much of a marker split across chunks has been received.
+
+    Only the last len(marker) - 1 characters can take part in a partial
+    match, so just those are run through the KMP automaton, without slicing.
+    """
+    state = 0
+    for i in range(max(0, len(text) - len(marker) + 1), len(text)):
+        char = text[i]
+        while state and char != marker[state]:
+            state = failure[state - 1]
+        if char == marker[state]:
+            state += 1
+            if state == len(marker):
+                state = failure[state - 1]
+    return state
+
+
+def _starts_escape(text: str, index: int) -> bool:
+    """
+    Return whether the backslash at the index starts an escape, rather than
+    being the second half of an escaped backslash.
+    """
+    run_start = index
+    while run_start and text[run_start - 1] == "\\":
+        run_start -= 1
+    return (index - run_start) % 2 == 0
+
+
+def _is_high_surrogate_escape(text: str, index: int) -> bool:
+    """
+    Return whether a complete \\uXXXX escape for the first half of a
+    surrogate pair starts at the index.
+    """
+    return (
+        index >= 0
+        and text.startswith("\\u", index)
+        and len(text) - index >= MAX_ESCAPE_LENGTH
+        and text[index + 2 : index + 4].lower() in HIGH_SURROGATE_PREFIXES
+        and _starts_escape(text, index)
+    )
+
+
+def _incomplete_escape_start(text: str) -> int:
+    """
+    Return the index where an incomplete escape sequence at the end of the
+    text starts, or len(text) if the text doesn't end inside one. A JSON
+    escape is a backslash and one character, or \\u and four hex digits, so
+    only the last backslash near the end of the text needs checking. The
+    first half of a surrogate pair counts as incomplete until the second
+    half has fully arrived, so if it comes just before the end or just
+    before an incomplete escape, the text is held back from its start.
+    """
+    start = len(text)
+    last = text.rfind("\\", max(0, len(text) - MAX_ESCAPE_LENGTH))
+    if last != -1 and _starts_escape(text, last):
+        remaining = len(text) - last
+        if remaining == 1 or (text[last + 1] == "u" and remaining < MAX_ESCAPE_LENGTH):
+            start = last
+    if _is_high_surrogate_escape(text, start - MAX_ESCAPE_LENGTH):
+        return start - MAX_ESCAPE_LENGTH
+    return start
+
+
+def _unescape(text: str) -> str:
+    """
+    Undo the JSON escapes in the text with the C JSON string scanner. Text
+    that isn't a valid JSON string body, such as one with \\', is unescaped
+    as a Python string literal instead, or left as is if that fails too.
+    """
+    try:
+        unescaped, end = scanstring(text + '"', 0, False)
+        if end == len(text) + 1:
+            return unescaped
+    except ValueError:
+        pass
+    try:
+        # Characters beyond Latin-1 are turned into escapes so that they
+        # survive decoding unchanged.
+        return codecs.decode(
+            text.encode("latin-1", "backslashreplace"), "unicode_escape"
+        )
+    except UnicodeDecodeError:
+        return text
 
 
 class ContentPrinter:
@@ -21,20 +141,41 @@ class ContentPrinter:
     content.
 
     The chunks are accumulated in case the start and end markers are split
-    across chunks.
+    across chunks. They are kept in a list and only joined when the pending
+    text is searched, so a long stream isn't copied on every chunk. Likewise,
+    an escape sequence split across chunks is held back until it is complete
+    so that it is decoded in one piece. Output is written without flushing
+    and flushed in batches, at the end of the contents, and on finish().
     """
 
     def __init__(self):
         self.printing_contents = False
-        self.accumulated_chunk = ""
+        self._pending_chunks: List[str] = []
+        self._pending_escape = ""
+        self._unflushed_length = 0
+        self._last_flush_time = time.monotonic()
         self.something_printed = False
 
+    @property
+    def accumulated_chunk(self) -> str:
+        """The text received but not yet printed or skipped."""
+        if len(self._pending_chunks) > 1:
+            self._pending_chunks = ["".join(self._pending_chunks)]
+        return self._pending_chunks[0] if self._pending_chunks else ""
+
+    @accumulated_chunk.setter
+    def accumulated_chunk(self, text: str) -> None:
+        self._pending_chunks = [text] if text else []
+
     def print_chunk(self, chunk_text: str) -> None:
         """Print chunks if we've detected the start marker."""
-        self.accumulated_chunk += chunk_text
+        if chunk_text:
+            self._pending_chunks.append(chunk_text)
         if self.printing_contents:
             self._continue_printing_content()
-        else:
+        elif '"' in chunk_text:
+            # The start marker ends with a quote, so only a chunk with a quote
+            # can complete it. Otherwise, the pending text isn't searched.
             self._start_printing_content()
 
     def finish(self) -> None:
@@ -43,72 +184,79 @@ class ContentPrinter:
         Call after a GPT request to ensure the next prompt is on a new
         line.
         """
+        self._finish_contents()
         if self.something_printed:
-            print()
+            print(flush=True)
 
     def _print_unescaped_chunk(self, chunk_text: str) -> None:
-        """Print the given chunk but undo escaped characters."""
-        try:
-            unescaped = codecs.decode(chunk_text, "unicode_escape")
-        except UnicodeDecodeError:
-            unescaped = chunk_text
+        """
+        Print the given chunk but undo escaped characters. An incomplete
+        escape sequence at the end of the chunk is held back until the rest of
+        it arrives.
+        """
+        text = self._pending_escape + chunk_text
+        complete_length = _incomplete_escape_start(text)
+        self._pending_escape = text[complete_length:]
+        self._decode_and_print(text[:complete_length])
+
+    def _flush_pending_escape(self) -> None:
+        """Print any held back escape sequence as is."""
+        if self._pending_escape:
+            self._decode_and_print(self._pending_escape)
+            self._pending_escape = ""
+
+    def _finish_contents(self) -> None:
+        """Print any held back text and flush the output."""
+        self._flush_pending_escape()
+        self._flush_output()
+
+    def _flush_output(self) -> None:
+        """Flush the text written so far to the terminal."""
+        if self._unflushed_length:
+            sys.stdout.flush()
+            self._unflushed_length = 0
+        self._last_flush_time = time.monotonic()
+
+    def _decode_and_print(self, text: str) -> None:
+        """Undo escaped characters in the text and print it."""
+        unescaped = _unescape(text)
         if unescaped:
-            print(unescaped, end="", flush=True)
-            self.something_printed = True
+            sys.stdout.write(unescaped)
+            self._unflushed_length += len(unescaped)
+            if (
+                self._unflushed_length >= FLUSH_SIZE
+                or time.monotonic() - self._last_flush_time >= FLUSH_INTERVAL
+            ):
+                self._flush_output()
+            if not self.something_printed:
+                self.something_printed = True
 
     def _continue_printing_content(self) -> None:
         """Print chunks, watching for the end marker."""
-        if CONTENTS_END_MARKER in self.accumulated_chunk:
-            end_index = self.accumulated_chunk.index(CONTENTS_END_MARKER)
-            self._print_unescaped_chunk(self.accumulated_chunk[:end_index])
-            self.accumulated_chunk = self.accumulated_chunk[end_index:]
-            if len(self.accumulated_chunk) >= len(CONTENTS_END_MARKER):
-                self.accumulated_chunk = self.accumulated_chunk[
-                    len(CONTENTS_END_MARKER) :
-                ]
-                self.printing_contents = False
-        else:
-            # The end marker may be split across chunks, so look for a
-            # partial match.
-            potential_end_index = -1
-            for i in range(len(CONTENTS_END_MARKER)):
-                if self.accumulated_chunk.endswith(CONTENTS_END_MARKER[: i + 1]):
-                    potential_end_index = len(self.accumulated_chunk) - (i + 1)
-                    break
-            if potential_end_index != -1:
-                # If we found a partial match, print up to the match and
-                # leave the partial end marker in the chunk buffer.
-                self._print_unescaped_chunk(
-                    self.accumulated_chunk[:potential_end_index]
-                )
-                self.accumulated_chunk = self.accumulated_chunk[potential_end_index:]
-                return
-
-            if self.accumulated_chunk.endswith("\\"):
-                self._print_unescaped_chunk(self.accumulated_chunk[:-1])
-                self.accumulated_chunk = "\\"
-                return
-
-            self._print_unescaped_chunk(self.accumulated_chunk)
-            self.accumulated_chunk = ""
-            self.printing_contents = True
+        contents, end_marker, rest = self.accumulated_chunk.partition(
+            CONTENTS_END_MARKER
+        )
+        if end_marker:
+            self._print_unescaped_chunk(contents)
+            self._finish_contents()
+            self.accumulated_chunk = rest
+            self.printing_contents = False
+            return
+
+        # The end marker may be split across chunks, so print up to any
+        # partial match and leave it in the chunk buffer.
+        end_index = len(contents) - _partial_marker_length(
+            contents, CONTENTS_END_MARKER, _END_MARKER_FAILURE
+        )
+        self._print_unescaped_chunk(contents[:end_index])
+        self.accumulated_chunk = contents[end_index:]
+        self.printing_contents = True
 
     def _start_printing_content(self) -> None:
         """Look for the start of the content marker and print the contents."""
-        if CONTENTS_START_MARKER in self.accumulated_chunk:
-            start_index = self.accumulated_chunk.index(CONTENTS_START_MARKER) + len(
-                CONTENTS_START_MARKER
-            )
-            end_index = self.accumulated_chunk.find(CONTENTS_END_MARKER, start_index)
-            if end_index != -1:
-                self._print_unescaped_chunk(
-                    self.accumulated_chunk[start_index:end_index]
-                )
-                self.accumulated_chunk = self.accumulated_chunk[
-                    end_index + len(CONTENTS_END_MARKER) :
-                ]
-                self.printing_contents = False
-            else:
-                self._print_unescaped_chunk(self.accumulated_chunk[start_index:])
-                self.accumulated_chunk = ""
-                self.printing_contents = True
+        _, start_marker, rest = self.accumulated_chunk.partition(CONTENTS_START_MARKER)
+        if start_marker:
+            # The rest is handled like any later chunk so that a partial end
+            # marker at its end is held back rather than printed.
+            self.accumulated_chunk = rest
+            self._continue_printing_content()
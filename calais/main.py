@@ -3,26 +3,36 @@ Main module for calais. This module initializes the GPT-4 model, sends
 prompts to the model, and processes the responses.
 """
 
+import functools
 import os
 import platform
 import re
-import subprocess
 import sys
-from typing_extensions import NoReturn
+from typing import Dict, NoReturn
 
-from calais.chat import Chat, Role
+from calais.cache import ResponseCache
+from calais.chat import Chat, ChatConfig, Role
 from calais.client import OpenAIClient
+from calais.semantic_cache import SemanticCache
 from calais.system_prompt import COMMAND_SYSTEM_PROMPT
 
 # GPT-4 parameters:
 MODEL = "gpt-4"
 MAX_TOKENS = 4096
 TEMPERATURE = 0.3
+# Pass this flag to ask GPT-4 again rather than use cached responses.
+NO_CACHE_FLAG = "--no-cache"
+# Every conversation starts with the same system prompt, so they share one
+# key for OpenAI's prompt cache.
+PROMPT_CACHE_KEY = "calais"
 
 # Chat parameters:
 MAX_RETRIES = 3
 RETRY_DELAY = 5  # Seconds
 TIMEOUT = 60  # Seconds
+# The number of user and assistant messages to send with each prompt. Older
+# messages are dropped, but the system prompt is always sent.
+HISTORY_WINDOW = 20
 # GPT can sometimes stall, returning empty chunks. Count these and retry if
 # the count exceeds this value.
 MAX_EMPTY_CHUNKS = 100
@@ -53,12 +63,41 @@ UNSAFE_STRINGS = [
     "format c: /q",
     "truncate -s 0",
 ]
+# All of the unsafe strings as one pattern, so a command is scanned once.
+UNSAFE_PATTERN = re.compile("|".join(map(re.escape, UNSAFE_STRINGS)))
+# The user's prompts are only checked for the clearly destructive strings, so
+# that prompts such as "show my history | grep ssh" still reach GPT-4. They are
+# checked regardless of case, since GPT-4 would read them that way.
+UNSAFE_PROMPT_STRINGS = [
+    string for string in UNSAFE_STRINGS if string not in ("history | ", "truncate -s 0")
+]
+UNSAFE_PROMPT_PATTERN = re.compile(
+    "|".join(map(re.escape, UNSAFE_PROMPT_STRINGS)), re.IGNORECASE
+)
+# The error GPT-4 is asked to return for unsafe requests. Prompts that contain
+# an unsafe prompt string are rejected with it without calling the API.
+UNSAFE_COMMAND_ERROR = "[unsafe command requested]"
+
+# Placeholders for user input in commands are surrounded by angle brackets.
+PLACEHOLDER_PATTERN = re.compile(r"<([^<>]+)>")
+# Placeholder values that would aim the command at the root directory, after
+# stripping.
+UNSAFE_INPUTS = frozenset({"/", "/*"})
 
+# User choices at the prompts, after stripping and lowercasing.
+RUN_CHOICES = frozenset({"", "r"})
+QUIT_CHOICES = frozenset({"q", "quit", "exit"})
+EXPLAIN_CHOICES = frozenset({"e", "ex", "explain"})
 
-def initialize_gpt(system_prompt: str) -> Chat:
+
+def initialize_gpt(system_prompt: str, use_cache: bool = True) -> Chat:
     """Initialize the GPT-4 model
 
-    Check for the API key, create a chat object, and set the system prompt.
+    Check for the API key, create a chat object, and set the system prompt
+    and the OS.
+    Responses are cached in the file named by CALAIS_CACHE, if it is set,
+    and looked up by similar prompts in the file named by
+    CALAIS_SEMANTIC_CACHE, if it is set, unless use_cache is False.
     """
     if "OPENAI_API_KEY" not in os.environ:
         print(
@@ -70,18 +109,60 @@ def initialize_gpt(system_prompt: str) -> Chat:
         MODEL,
         MAX_TOKENS,
         TEMPERATURE,
+        PROMPT_CACHE_KEY,
     )
-    gpt = Chat(
-        chat_client,
-        MAX_RETRIES,
-        TIMEOUT,
-        RETRY_DELAY,
-        MAX_EMPTY_CHUNKS,
+    cache = None
+    semantic_cache = None
+    if use_cache and "CALAIS_CACHE" in os.environ:
+        cache = ResponseCache(os.environ["CALAIS_CACHE"], MODEL, TEMPERATURE)
+    if use_cache and "CALAIS_SEMANTIC_CACHE" in os.environ:
+        semantic_cache = SemanticCache(
+            os.environ["CALAIS_SEMANTIC_CACHE"],
+            MODEL,
+            TEMPERATURE,
+            functools.partial(chat_client.embed, timeout=TIMEOUT),
+        )
+    config = ChatConfig(
+        retries=MAX_RETRIES,
+        timeout=TIMEOUT,
+        retry_delay=RETRY_DELAY,
+        max_empty_chunks=MAX_EMPTY_CHUNKS,
+        history_window=HISTORY_WINDOW,
+    )
+    gpt = Chat(chat_client, config, cache=cache, semantic_cache=semantic_cache)
+    # The OS is in its own message after the static system prompt so that the
+    # prompt stays a byte-identical prefix for prompt caching.
+    gpt.add_messages(
+        [
+            (Role.SYSTEM, system_prompt),
+            (Role.SYSTEM, f"The OS is {platform.system()}."),
+        ]
     )
-    gpt.add_to_conversation(Role.SYSTEM, system_prompt)
     return gpt
 
 
+def run_command(command: str) -> NoReturn:
+    """Run the command in the shell and exit.
+
+    On POSIX systems the shell replaces this process, so the interpreter's
+    memory is released while the command runs and the command's exit status
+    becomes Calais's.
+    """
+    sys.stdout.flush()
+    if os.name == "posix":
+        os.execv("/bin/sh", ["sh", "-c", command])
+    # Only imported when a command is run, to keep startup fast.
+    # pylint: disable-next=import-outside-toplevel
+    import subprocess
+
+    try:
+        subprocess.run(command, shell=True, check=True)
+    except KeyboardInterrupt:
+        print("Execution interrupted by user. Exiting.")
+    finally:
+        sys.exit(0)
+
+
 def do_command(response):
     """Handle a command response from GPT-4.
 
@@ -92,26 +173,36 @@ def do_command(response):
     print(f"Command: `{command}`")
     # The stream handler will have printed the explanation, if any, in
     # the contents.
-    user_input = input("[r]un,(e)xplain],(q)uit, or continue chatting: ")
-
-    match user_input.lower():
-        case "" | "R" | "r":
-            try:
-                subprocess.run(command, shell=True, check=True)
-            except KeyboardInterrupt:
-                print("Execution interrupted by user. Exiting.")
-            finally:
-                sys.exit(0)
-        case "q" | "quit" | "exit":
-            sys.exit(0)
-        case "e" | "ex" | "explain":
-            user_prompt = f"Explain the command `{command}`. Return the command in the command field and the explanation in the content field."
-            return user_prompt
-        case _:
-            user_prompt = input("\n> Prompt ([q] to quit): ")
-            if user_prompt.lower() in ["", "q", "quit", "exit"]:
-                sys.exit(0)
-            return user_prompt
+    choice = input("[r]un,(e)xplain],(q)uit, or continue chatting: ").strip().lower()
+
+    if choice in RUN_CHOICES:
+        run_command(command)
+    if choice in QUIT_CHOICES:
+        sys.exit(0)
+    if choice in EXPLAIN_CHOICES:
+        user_prompt = f"Explain the command `{command}`. Return the command in the command field and the explanation in the content field."
+        return user_prompt
+    return check_prompt(ask_for_prompt())
+
+
+def ask_for_prompt() -> str:
+    """Ask the user for a new prompt, exiting if they quit."""
+    user_prompt = input("\n> Prompt ([q] to quit): ")
+    if not user_prompt or user_prompt.lower() in QUIT_CHOICES:
+        sys.exit(0)
+    return user_prompt
+
+
+def check_prompt(user_prompt: str) -> str:
+    """Check the prompt of the user for clearly destructive requests.
+
+    An unsafe prompt is rejected without calling the API, and the user is
+    asked for another one.
+    """
+    while UNSAFE_PROMPT_PATTERN.search(" ".join(user_prompt.split())):
+        print(f"Unsafe request {UNSAFE_COMMAND_ERROR}.")
+        user_prompt = ask_for_prompt()
+    return user_prompt
 
 
 def do_content_prompt():
@@ -120,16 +211,19 @@ def do_content_prompt():
     The response content will have been printed by the stream handler.
     """
     user_prompt = input("[q]uit, or continue chatting: ")
-
-    match user_prompt.lower():
-        case "" | "q" | "quit" | "exit":
-            sys.exit(0)
-        case _:
-            return user_prompt
+    choice = user_prompt.strip().lower()
+    if not choice or choice in QUIT_CHOICES:
+        sys.exit(0)
+    return check_prompt(user_prompt)
 
 
 def converse(gpt: Chat, user_prompt: str) -> NoReturn:
-    """Chat with GPT-4, looping until the user decides to stop."""
+    """Chat with GPT-4, looping until the user decides to stop.
+
+    The prompts typed by the user are checked before they're sent. Explain
+    prompts aren't, since their command has already passed review_command.
+    """
+    user_prompt = check_prompt(user_prompt)
     while True:
         response = gpt.call_gpt4(user_prompt, True)
         if response.error:
@@ -148,7 +242,7 @@ def converse(gpt: Chat, user_prompt: str) -> NoReturn:
 def review_command(command: str) -> str:
     """Review the command returned by GPT-4 for safety."""
     command = " ".join(command.strip().split())
-    if any([string in command for string in UNSAFE_STRINGS]):
+    if UNSAFE_PATTERN.search(command):
         # The stream handler will have printed the error message in the
         # contents.
         print("Unsafe command. Exiting.")
@@ -159,7 +253,7 @@ def review_command(command: str) -> str:
 def check_input(match: re.Match) -> str:
     """Check the input of the user for root directory operations."""
     user_input = input(f"Enter the value for {match.group(0)}: ")
-    if user_input == "/" or user_input == "/*":
+    if user_input.strip() in UNSAFE_INPUTS:
         print(f"Unsafe input {user_input}. Exiting.")
         sys.exit(1)
     return user_input
@@ -169,20 +263,28 @@ def process_command(command: str) -> str:
     """Process the command returned by GPT-4.
 
     Ask the user for input for each placeholder surrounded by angle brackets.
+    A placeholder that appears more than once is only asked for once.
     """
-    pattern = r"<([^<>]+)>"
     # Simple, non-matching count of angle brackets.
-    if len(re.findall(r"<", command)) != len(re.findall(r">", command)):
+    if command.count("<") != command.count(">"):
         raise ValueError("Mismatched angle brackets")
-    return re.sub(pattern, check_input, command)
+    values: Dict[str, str] = {}
+
+    def substitute(match: re.Match) -> str:
+        placeholder = match.group(0)
+        if placeholder not in values:
+            values[placeholder] = check_input(match)
+        return values[placeholder]
+
+    return PLACEHOLDER_PATTERN.sub(substitute, command)
 
 
 def main() -> None:
     """Main entry point for Calais."""
-    os_name = platform.system()
-    system_prompt = COMMAND_SYSTEM_PROMPT + f"\n The OS is {os_name}."
-    gpt = initialize_gpt(system_prompt)
-    user_prompt = " ".join(sys.argv[1:])
+    args = sys.argv[1:]
+    use_cache = NO_CACHE_FLAG not in args
+    gpt = initialize_gpt(COMMAND_SYSTEM_PROMPT, use_cache)
+    user_prompt = " ".join(arg for arg in args if arg != NO_CACHE_FLAG)
     if user_prompt == "":
         user_prompt = input("> Prompt: ")
     try:
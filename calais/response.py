@@ -1,12 +1,12 @@
 """This module contains the Response class, which represents the response from the OpenAI API."""
 
 from __future__ import annotations
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
 import json
 from typing import Optional
 
 
-@dataclass
+@dataclass(slots=True)
 class Response:
     """Represents a response from the OpenAI API."""
 
@@ -16,7 +16,9 @@ class Response:
 
     def to_json(self):
         """Convert the Response object to a JSON string."""
-        return json.dumps(asdict(self))
+        return json.dumps(
+            {"content": self.content, "command": self.command, "error": self.error}
+        )
 
     @classmethod
     def from_json(cls, json_str: str) -> Response:
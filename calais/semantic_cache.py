@@ -0,0 +1,142 @@
+"""
+Semantic cache module to reuse responses to prompts that are worded
+differently but mean the same thing, such as "list text files" and "show all
+.txt files".
+"""
+
+from __future__ import annotations
+import functools
+import math
+import operator
+import sqlite3
+import time
+from array import array
+from typing import TYPE_CHECKING, Callable, List, Optional, Sequence, Tuple
+
+if TYPE_CHECKING:
+    from openai.types.chat import ChatCompletionMessageParam
+
+from calais.cache import MAX_AGE, conversation_key
+from calais.response import Response
+
+# The least cosine similarity between two prompts for one to reuse the
+# other's response.
+SIMILARITY_THRESHOLD = 0.92
+# The number of recent prompt embeddings to keep in memory.
+EMBEDDING_CACHE_SIZE = 128
+# The number of prompts to keep. Every lookup compares the prompt with all of
+# the stored prompts after the same conversation, so this is far smaller than
+# the exact cache's limit to keep lookups much faster than an API call.
+MAX_ENTRIES = 1_000
+
+
+def normalize(vector: Sequence[float]) -> List[float]:
+    """Return the vector scaled to unit length, or unchanged if it is zero."""
+    norm = math.hypot(*vector)
+    return [x / norm for x in vector] if norm else list(vector)
+
+
+def dot(a: Sequence[float], b: Sequence[float]) -> float:
+    """
+    Return the dot product of two vectors, which is their cosine similarity
+    if both have unit length.
+    """
+    return sum(map(operator.mul, a, b))
+
+
+class SemanticCache:
+    """
+    An on-disk cache of responses, looked up by the similarity of the user's
+    prompt to earlier prompts. Only responses to prompts that followed the
+    same conversation, with the same model parameters, are reused. Embeddings
+    are stored with unit length so that comparing two is a dot product.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model: str,
+        temperature: float,
+        embed: Callable[[str], List[float]],
+        threshold: float = SIMILARITY_THRESHOLD,
+        max_entries: int = MAX_ENTRIES,
+        max_age: float = MAX_AGE,
+    ) -> None:
+        self.model: str = model
+        self.temperature: float = temperature
+        # Embedding the same prompt twice would cost another API call.
+        self.embed: Callable[[str], List[float]] = functools.lru_cache(
+            maxsize=EMBEDDING_CACHE_SIZE
+        )(embed)
+        self.threshold: float = threshold
+        self.max_entries: int = max_entries
+        self.max_age: float = max_age
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS prompts (id INTEGER PRIMARY KEY, "
+            "context TEXT NOT NULL, prompt TEXT NOT NULL, embedding BLOB NOT NULL, "
+            "response TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS prompts_context ON prompts (context)"
+        )
+        self.connection.commit()
+
+    def _context(self, context: Sequence[ChatCompletionMessageParam]) -> str:
+        """Return the key for the conversation preceding a prompt."""
+        return conversation_key(self.model, self.temperature, context)
+
+    def get(
+        self, context: Sequence[ChatCompletionMessageParam], prompt: str
+    ) -> Optional[Tuple[str, Response]]:
+        """
+        Return the most similar prompt that followed the same context and the
+        response to it, or None if no earlier prompt is similar enough.
+        """
+        rows = self.connection.execute(
+            "SELECT prompt, embedding, response FROM prompts "
+            "WHERE context = ? AND created >= ?",
+            (self._context(context), time.time() - self.max_age),
+        ).fetchall()
+        if not rows:
+            return None
+        embedding = normalize(self.embed(prompt))
+        best_row = None
+        best_similarity = self.threshold
+        for row in rows:
+            similarity = dot(embedding, array("f", row[1]))
+            if similarity >= best_similarity:
+                best_row, best_similarity = row, similarity
+        if best_row is None:
+            return None
+        return best_row[0], Response.from_json(best_row[2])
+
+    def set(
+        self,
+        context: Sequence[ChatCompletionMessageParam],
+        prompt: str,
+        response: Response,
+    ) -> None:
+        """Store the response to the prompt, evicting the oldest if full."""
+        now = time.time()
+        self.connection.execute(
+            "INSERT INTO prompts (context, prompt, embedding, response, created) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                self._context(context),
+                prompt,
+                array("f", normalize(self.embed(prompt))).tobytes(),
+                response.to_json(),
+                now,
+            ),
+        )
+        self.connection.execute(
+            "DELETE FROM prompts WHERE created < ? OR id NOT IN "
+            "(SELECT id FROM prompts ORDER BY id DESC LIMIT ?)",
+            (now - self.max_age, self.max_entries),
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        """Close the connection to the cache database."""
+        self.connection.close()
@@ -0,0 +1,84 @@
+"""Tests for the ResponseCache class."""
+
+import itertools
+
+import pytest
+
+from calais.cache import ResponseCache
+from calais.response import Response
+
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture
+def cache(tmp_path) -> ResponseCache:
+    """Create a ResponseCache in a temporary directory."""
+    return ResponseCache(str(tmp_path / "cache.db"), "gpt-4", 0.3, max_entries=2)
+
+
+CONVERSATION = [
+    {"role": "system", "content": "You are a shell."},
+    {"role": "user", "content": "list files"},
+]
+
+
+class TestKey:
+    """Test the key method of the ResponseCache class."""
+
+    def test_key_is_stable(self, cache) -> None:
+        """Test that the same conversation gives the same key."""
+        assert cache.key(CONVERSATION) == cache.key(list(CONVERSATION))
+
+    def test_key_depends_on_conversation(self, cache) -> None:
+        """Test that a different conversation gives a different key."""
+        other = CONVERSATION[:1] + [{"role": "user", "content": "list dirs"}]
+        assert cache.key(CONVERSATION) != cache.key(other)
+
+    def test_key_depends_on_model_parameters(self, cache, tmp_path) -> None:
+        """Test that different model parameters give a different key."""
+        other = ResponseCache(str(tmp_path / "other.db"), "gpt-4", 0.7)
+        assert cache.key(CONVERSATION) != other.key(CONVERSATION)
+
+
+class TestGetSet:
+    """Test the get and set methods of the ResponseCache class."""
+
+    def test_get_missing(self, cache) -> None:
+        """Test that a missing key returns None."""
+        assert cache.get("missing") is None
+
+    def test_set_then_get(self, cache) -> None:
+        """Test that a stored response is returned."""
+        response = Response("-l is long format", "ls -l", None)
+        cache.set("key", response)
+        assert cache.get("key") == response
+
+    def test_persists_across_instances(self, cache, tmp_path) -> None:
+        """Test that responses are kept on disk."""
+        response = Response(None, "ls -l", None)
+        cache.set("key", response)
+        cache.close()
+        reopened = ResponseCache(str(tmp_path / "cache.db"), "gpt-4", 0.3)
+        assert reopened.get("key") == response
+
+    def test_evicts_least_recently_used(self, cache, mocker) -> None:
+        """Test that the least recently used response is evicted when full."""
+        mocker.patch("time.time", side_effect=itertools.count(1))
+        cache.set("a", Response("a", None, None))
+        cache.set("b", Response("b", None, None))
+        cache.get("a")  # "b" is now the least recently used.
+        cache.set("c", Response("c", None, None))
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        assert cache.get("c") is not None
+
+    def test_expires_old_responses(self, cache, mocker) -> None:
+        """Test that a response older than max_age is not returned."""
+        mock_time = mocker.patch("time.time", return_value=0.0)
+        cache.set("key", Response(None, "ls -l", None))
+        mock_time.return_value = cache.max_age
+        assert cache.get("key") is not None
+        mock_time.return_value = cache.max_age + 1
+        assert cache.get("key") is None
+        mock_time.return_value = 0.0
+        assert cache.get("key") is None  # Expired responses are deleted.
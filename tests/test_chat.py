@@ -1,11 +1,12 @@
 """Tests for the Chat class."""
 
+from dataclasses import replace
 from typing import Iterable, List, Literal, Optional
 from unittest import mock
 from unittest.mock import patch, Mock
 import pytest
 
-from openai import Stream
+from openai import APITimeoutError, OpenAIError, RateLimitError, Stream
 from openai.types.chat.chat_completion_chunk import (
     Choice,
     ChoiceDelta,
@@ -16,15 +17,22 @@ from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 
+from calais.cache import ResponseCache
+from calais.semantic_cache import SemanticCache
 from calais.chat import (
+    MAX_RETRY_DELAY,
     Chat,
+    ChatConfig,
     ChatError,
     Role,
 )
 from calais.client import IOpenAIClient
+from calais.response import Response
 
 # pylint: disable=redefined-outer-name
 
+CONFIG = ChatConfig(retries=1, timeout=1, retry_delay=1, max_empty_chunks=1)
+
 
 class MockOpenAIClient(IOpenAIClient):
     """Mock implementation of the IOpenAIClient interface."""
@@ -34,10 +42,10 @@ class MockOpenAIClient(IOpenAIClient):
         self.mock = Mock()
 
     def call_api(
-        self, messages: Iterable[ChatCompletionMessageParam]
+        self, messages: Iterable[ChatCompletionMessageParam], timeout: float
     ) -> ChatCompletion | Stream[ChatCompletionChunk]:
         """Call the OpenAI API with the given messages."""
-        return self.mock.call_api(messages)
+        return self.mock.call_api(messages, timeout)
 
 
 @pytest.fixture
@@ -49,7 +57,8 @@ def mock_client() -> MockOpenAIClient:
 @pytest.fixture
 def chat_instance():
     """Create a Chat instance with default parameters."""
-    return Chat(client=None, retries=3, timeout=10, retry_delay=5, max_empty_chunks=3)
+    config = ChatConfig(retries=3, timeout=10, retry_delay=5, max_empty_chunks=3)
+    return Chat(client=None, config=config)
 
 
 @pytest.fixture
@@ -86,24 +95,14 @@ class TestInit:
     def test_chat_init(self, mocker) -> None:
         """Test the __init__ method of the Chat class."""
         fake_client = mocker.MagicMock()
-        retries = 3
-        timeout = 10
-        retry_delay = 5
-        max_empty_chunks = 3
-
-        gpt = Chat(
-            fake_client,
-            retries=retries,
-            timeout=timeout,
-            retry_delay=retry_delay,
-            max_empty_chunks=max_empty_chunks,
-        )
+        config = ChatConfig(retries=3, timeout=10, retry_delay=5, max_empty_chunks=3)
+
+        gpt = Chat(fake_client, config)
 
         assert gpt.client == fake_client
-        assert gpt.max_retries == retries
-        assert gpt.timeout == timeout
-        assert gpt.retry_delay == retry_delay
-        assert gpt.max_empty_chunks == max_empty_chunks
+        assert gpt.config == config
+        assert gpt.config.history_window is None
+        assert gpt.cache is None
         assert not gpt.conversation
 
 
@@ -113,7 +112,7 @@ class TestAddToConversation:
     def test_add_to_conversation_system(self):
         """Test the add_to_conversation method of the Chat class for system."""
 
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
         chat.add_to_conversation(Role.SYSTEM, "Hello")
         assert len(chat.conversation) == 1
         assert chat.conversation[0]["role"] == "system"
@@ -122,7 +121,7 @@ class TestAddToConversation:
     def test_add_to_conversation_assistant(self):
         """Test the add_to_conversation method of the Chat class for assistant."""
 
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
         chat.add_to_conversation(Role.ASSISTANT, "Hello")
         assert len(chat.conversation) == 1
         assert chat.conversation[0]["role"] == "assistant"
@@ -131,12 +130,74 @@ class TestAddToConversation:
     def test_add_to_conversation_user(self):
         """Test the add_to_conversation method of the Chat class for user."""
 
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
         chat.add_to_conversation(Role.USER, "Hello")
         assert len(chat.conversation) == 1
         assert chat.conversation[0]["role"] == "user"
         assert chat.conversation[0]["content"] == "Hello"
 
+    def test_add_messages(self):
+        """Test the add_messages method of the Chat class."""
+
+        chat = Chat(None, CONFIG)
+        chat.add_messages([(Role.SYSTEM, "Hello"), (Role.USER, "Hi")])
+        assert chat.conversation == [
+            {"role": "system", "content": "Hello"},
+            {"role": "user", "content": "Hi"},
+        ]
+
+    def test_add_messages_invalid_role(self):
+        """Test that add_messages adds nothing if any role is invalid."""
+
+        chat = Chat(None, CONFIG)
+        with pytest.raises(ChatError, match="Invalid role"):
+            chat.add_messages([(Role.SYSTEM, "Hello"), ("user", "Hi")])
+        assert not chat.conversation
+
+    def test_add_to_conversation_invalid_role(self):
+        """Test the add_to_conversation method of the Chat class for a bad role."""
+
+        chat = Chat(None, CONFIG)
+        with pytest.raises(ChatError, match="Invalid role"):
+            chat.add_to_conversation("user", "Hello")
+        assert not chat.conversation
+
+
+class TestMessagesToSend:
+    """Test the _messages_to_send method of the Chat class."""
+
+    @staticmethod
+    def make_chat(history_window, turns):
+        """Create a Chat with two system messages and the given user turns."""
+        chat = Chat(None, replace(CONFIG, history_window=history_window))
+        chat.add_to_conversation(Role.SYSTEM, "system prompt")
+        chat.add_to_conversation(Role.SYSTEM, "The OS is Linux.")
+        for i in range(turns):
+            chat.add_to_conversation(Role.USER, f"user {i}")
+        return chat
+
+    def test_no_window_sends_everything(self):
+        """Test that without a window the whole conversation is sent."""
+        chat = self.make_chat(None, 30)
+        assert chat._messages_to_send() == chat.conversation
+
+    def test_short_history_sends_everything(self):
+        """Test that a history within the window is sent whole."""
+        chat = self.make_chat(4, 4)
+        assert chat._messages_to_send() == chat.conversation
+
+    @pytest.mark.parametrize(
+        "turns, first_kept", [(5, 2), (6, 2), (7, 4), (8, 4), (9, 6)]
+    )
+    def test_long_history_drops_half_windows(self, turns, first_kept):
+        """Test that old messages are dropped half a window at a time."""
+        chat = self.make_chat(4, turns)
+        messages = chat._messages_to_send()
+        assert messages[:2] == chat.conversation[:2]
+        assert messages[2]["content"] == f"user {first_kept}"
+        assert messages[-1] == chat.conversation[-1]
+        assert len(messages) - 2 <= 4
+
 
 class MockDelta:
     """Mock Delta class."""
@@ -163,14 +224,14 @@ class TestProcessResponseChunk:
 
         mock_chunk = mocker.MagicMock()
         mock_chunk.choices = [mock_choice]
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
         content, stop = chat._process_response_chunk(mock_chunk)
         assert content == "Hello"
         assert not stop
 
     def test_process_response_chunk_multiple(self, mocker):
         """Now multiple chunks."""
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
 
         mock_chunk1 = mocker.MagicMock()
         mock_chunk2 = mocker.MagicMock()
@@ -197,7 +258,7 @@ class TestProcessResponseChunk:
 
     def test_process_empty_content_chunk(self, mocker):
         """Test processing a chunk with empty content."""
-        chat = Chat(None, 1, 1, 1, 1)
+        chat = Chat(None, CONFIG)
 
         # Setup a mock chunk with empty content but no explicit stop condition
         mock_chunk_empty_content = mocker.MagicMock()
@@ -279,17 +340,11 @@ class TestCheckReturnedChunk:
 class TestCallGptApi:
     """Test the _call_api method of the Chat class."""
 
-    @pytest.fixture(autouse=True)
-    # pylint: disable=attribute-defined-outside-init
-    def _setup(self, chat_instance, make_mock_chunk):
-        self.chat = chat_instance
-        self.make_mock_chunk = make_mock_chunk
-
-    def test_normal_response_handling(self, chat_instance):
+    def test_normal_response_handling(self, chat_instance, make_mock_chunk):
         """Test normal response handling."""
         mock_chunks = [
-            self.make_mock_chunk(content="Hello, "),
-            self.make_mock_chunk(content="world!"),
+            make_mock_chunk(content="Hello, "),
+            make_mock_chunk(content="world!"),
         ]
         with mock.patch.object(
             chat_instance, "_call_api", return_value=mock_chunks
@@ -304,12 +359,12 @@ class TestCallGptApi:
             assert response_text == "Hello, world!"
             assert empty_count == 0
 
-    def test_empty_chunk_counting(self, chat_instance):
+    def test_empty_chunk_counting(self, chat_instance, make_mock_chunk):
         """Test counting of empty chunks."""
         mock_chunks = [
-            self.make_mock_chunk(content=" \t \n \r"),
-            self.make_mock_chunk(content=""),
-            self.make_mock_chunk(content=" "),
+            make_mock_chunk(content=" \t \n \r"),
+            make_mock_chunk(content=""),
+            make_mock_chunk(content=" "),
         ]
         with mock.patch.object(
             chat_instance, "_call_api", return_value=mock_chunks
@@ -324,11 +379,11 @@ class TestCallGptApi:
             assert response_text == " \t \n \r "
             assert empty_count == 3
 
-    def test_early_stop(self, chat_instance):
+    def test_early_stop(self, chat_instance, make_mock_chunk):
         """Test early stop condition."""
         mock_chunks = [
-            self.make_mock_chunk(content="Stop here", finish_reason="stop"),
-            self.make_mock_chunk(content="Should not see this"),
+            make_mock_chunk(content="Stop here", finish_reason="stop"),
+            make_mock_chunk(content="Should not see this"),
         ]
         with mock.patch.object(
             chat_instance, "_call_api", return_value=mock_chunks
@@ -343,6 +398,73 @@ class TestCallGptApi:
             assert response_text == "Stop here"
             assert empty_count == 0
 
+    def test_stream_chunk_texts_yields_until_stop(self, chat_instance, make_mock_chunk):
+        """Test that chunk texts are yielded as they arrive, up to the stop."""
+        mock_chunks = iter(
+            [
+                make_mock_chunk(content="Hello, "),
+                make_mock_chunk(content="world!", finish_reason="stop"),
+                make_mock_chunk(content="Should not see this"),
+            ]
+        )
+        with mock.patch.object(chat_instance, "_call_api", return_value=mock_chunks):
+            texts = chat_instance._stream_chunk_texts([])
+            assert next(texts) == "Hello, "
+            assert next(texts) == "world!"
+            with pytest.raises(StopIteration):
+                next(texts)
+        assert next(mock_chunks).choices[0].delta.content == "Should not see this"
+
+    @pytest.mark.parametrize("finish_reason", ["stop", "length"])
+    def test_stream_closed_when_done(
+        self, chat_instance, make_mock_chunk, finish_reason
+    ):
+        """Test that the response stream is closed on a stop or an error."""
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = iter(
+            [
+                make_mock_chunk(content="Hello", finish_reason=finish_reason),
+                make_mock_chunk(content="Should not see this"),
+            ]
+        )
+        with mock.patch.object(chat_instance, "_call_api", return_value=stream):
+            try:
+                chat_instance._call_gpt_api([])
+            except ChatError:
+                pass
+        stream.close.assert_called_once()
+
+    def test_oversized_response_raises(self, chat_instance, make_mock_chunk):
+        """Test that a response longer than the maximum raises and closes."""
+        chat_instance.config = replace(chat_instance.config, max_response_chars=8)
+        stream = mock.MagicMock()
+        stream.__iter__.return_value = iter(
+            [
+                make_mock_chunk(content="Hello, "),
+                make_mock_chunk(content="world!"),
+            ]
+        )
+        with mock.patch.object(chat_instance, "_call_api", return_value=stream):
+            with pytest.raises(ChatError, match="exceeded 8 characters"):
+                chat_instance._call_gpt_api([])
+        stream.close.assert_called_once()
+
+    def test_only_first_chunk_checked(self, chat_instance, make_mock_chunk):
+        """Test that only the first chunk of the stream is type checked."""
+        mock_chunks = [
+            make_mock_chunk(content="Hello, "),
+            make_mock_chunk(content="world"),
+            make_mock_chunk(content="!", finish_reason="stop"),
+        ]
+        with mock.patch.object(
+            chat_instance, "_call_api", return_value=mock_chunks
+        ), mock.patch.object(
+            chat_instance, "_check_returned_chunk", side_effect=lambda x: x
+        ) as mock_check:
+            response_text, _ = chat_instance._call_gpt_api([])
+        assert response_text == "Hello, world!"
+        mock_check.assert_called_once_with(mock_chunks[0])
+
     def test_timeout_handling(self, chat_instance):
         """Test handling of API call timeout."""
         with mock.patch.object(
@@ -360,9 +482,8 @@ class TestChatResponseGeneration:
     def chat_instance(self, mocker):
         """Fixture to create a Chat instance with default parameters."""
         client = mocker.MagicMock()
-        return Chat(
-            client=client, retries=3, timeout=10, retry_delay=1, max_empty_chunks=2
-        )
+        config = ChatConfig(retries=3, timeout=10, retry_delay=1, max_empty_chunks=2)
+        return Chat(client=client, config=config)
 
     @patch("calais.chat.Chat._call_gpt_api")
     @patch("time.sleep", return_value=None)
@@ -372,18 +493,17 @@ class TestChatResponseGeneration:
         """
         Test generate_response retries when receiving too many empty chunks and eventually raises ChatError.
         """
-        mock_call_gpt_api.return_value = (
-            "",
-            chat_instance.max_empty_chunks + 1,  # Exceed the max_empty_chunks limit.
-        )
+        # Exceed the max_empty_chunks limit.
+        empty_chunk_count = chat_instance.config.max_empty_chunks + 1
+        mock_call_gpt_api.return_value = ("", empty_chunk_count)
 
         with pytest.raises(ChatError) as exc_info:
             chat_instance._generate_response([], False)
 
         assert "Failed to receive a response from OpenAI." in str(exc_info.value)
         # Ensure _call_gpt_api was called max_retries + 1 times (initial attempt + retries)
-        assert mock_call_gpt_api.call_count == chat_instance.max_retries + 1
-        assert mock_sleep.call_count == chat_instance.max_retries + 1
+        assert mock_call_gpt_api.call_count == chat_instance.config.retries + 1
+        assert mock_sleep.call_count == chat_instance.config.retries + 1
 
     @patch("calais.chat.Chat._call_gpt_api")
     @patch("time.sleep", return_value=None)
@@ -425,3 +545,160 @@ class TestChatResponseGeneration:
         assert "Failed to receive a response from OpenAI." in str(exc_info.value)
         assert mock_call_gpt_api.call_count == 4
         assert mock_sleep.call_count == 4
+
+
+class TestCallGpt4:
+    """Test the call_gpt4 method of the Chat class."""
+
+    @pytest.fixture
+    def cache(self, tmp_path) -> ResponseCache:
+        """Create a ResponseCache in a temporary directory."""
+        return ResponseCache(str(tmp_path / "cache.db"), "gpt-4", 0.3)
+
+    @patch("calais.chat.Chat._generate_response")
+    def test_without_cache(self, mock_generate_response):
+        """Test that the API is called and the prompt added to the conversation."""
+        mock_generate_response.return_value = Response(None, "ls -l", None)
+        chat = Chat(None, CONFIG)
+        assert chat.call_gpt4("list files", False).command == "ls -l"
+        assert chat.conversation[-1]["content"] == "list files"
+        mock_generate_response.assert_called_once()
+
+    @patch("calais.chat.Chat._generate_response")
+    def test_cache_hit_skips_api(self, mock_generate_response, cache, capsys):
+        """Test that a repeated conversation is answered from the cache."""
+        mock_generate_response.return_value = Response("long format", "ls -l", None)
+        Chat(None, CONFIG, cache=cache).call_gpt4("list files", False)
+
+        response = Chat(None, CONFIG, cache=cache).call_gpt4("list files", True)
+
+        assert response == Response("long format", "ls -l", None)
+        assert mock_generate_response.call_count == 1
+        assert capsys.readouterr().out == "long format\n"
+
+    @patch("calais.chat.Chat._generate_response")
+    def test_errors_not_cached(self, mock_generate_response, cache):
+        """Test that responses with errors aren't cached."""
+        mock_generate_response.return_value = Response(None, None, "error desc")
+        Chat(None, CONFIG, cache=cache).call_gpt4("erase disk", False)
+        Chat(None, CONFIG, cache=cache).call_gpt4("erase disk", False)
+        assert mock_generate_response.call_count == 2
+
+    @patch("calais.chat.Chat._generate_response")
+    def test_semantic_cache_hit_skips_api(
+        self, mock_generate_response, tmp_path, capsys
+    ):
+        """Test that a similar prompt is answered from the semantic cache."""
+        embeddings = {"list files": [1.0, 0.0], "show the files": [0.99, 0.1]}
+        semantic_cache = SemanticCache(
+            str(tmp_path / "semantic.db"), "gpt-4", 0.3, embeddings.__getitem__
+        )
+        mock_generate_response.return_value = Response(None, "ls", None)
+        chat = Chat(None, CONFIG, semantic_cache=semantic_cache)
+        chat.call_gpt4("list files", False)
+
+        chat = Chat(None, CONFIG, semantic_cache=semantic_cache)
+        assert chat.call_gpt4("show the files", False) == Response(None, "ls", None)
+        assert mock_generate_response.call_count == 1
+        assert 'Reused the command from the similar prompt "list files".' in (
+            capsys.readouterr().out
+        )
+
+    @patch("calais.chat.Chat._generate_response")
+    def test_semantic_cache_embedding_failure_is_miss(
+        self, mock_generate_response, tmp_path, mocker
+    ):
+        """Test that a failed embedding falls back to calling GPT-4."""
+        error = OpenAIError("embedding failed")
+        embed = mocker.MagicMock(side_effect=[[1.0, 0.0], error, error])
+        semantic_cache = SemanticCache(
+            str(tmp_path / "semantic.db"), "gpt-4", 0.3, embed
+        )
+        mock_generate_response.return_value = Response(None, "ls", None)
+        Chat(None, CONFIG, semantic_cache=semantic_cache).call_gpt4("list", False)
+
+        chat = Chat(None, CONFIG, semantic_cache=semantic_cache)
+        assert chat.call_gpt4("show files", False) == Response(None, "ls", None)
+        assert mock_generate_response.call_count == 2
+        assert embed.call_count == 3
+
+
+class TestRetries:
+    """Test the retry backoff of the Chat class."""
+
+    @pytest.fixture
+    def chat_instance(self, mocker):
+        """Fixture to create a Chat instance with default parameters."""
+        config = ChatConfig(retries=3, timeout=10, retry_delay=1, max_empty_chunks=2)
+        return Chat(client=mocker.MagicMock(), config=config)
+
+    @staticmethod
+    def rate_limit_error(mocker, headers) -> RateLimitError:
+        """Create a RateLimitError with the given response headers."""
+        response = mocker.MagicMock(headers=headers)
+        return RateLimitError("rate limited", response=response, body=None)
+
+    @pytest.mark.parametrize(
+        "attempt, expected", [(0, 1), (1, 2), (2, 4), (10, MAX_RETRY_DELAY)]
+    )
+    def test_backoff_delay(self, chat_instance, attempt, expected):
+        """Test that the delay doubles per attempt, is capped, and is jittered."""
+        with patch("random.random", return_value=0.5):
+            assert chat_instance._backoff_delay(attempt) == expected
+        with patch("random.random", return_value=0.0):
+            assert chat_instance._backoff_delay(attempt) == expected / 2
+
+    @patch("calais.chat.Chat._call_gpt_api")
+    @patch("time.sleep", return_value=None)
+    @pytest.mark.parametrize(
+        "retry_after, expected",
+        [("7", 7.0), ("86400", MAX_RETRY_DELAY), ("inf", MAX_RETRY_DELAY)],
+    )
+    def test_rate_limit_honors_retry_after(
+        self,
+        mock_sleep,
+        mock_call_gpt_api,
+        chat_instance,
+        mocker,
+        retry_after,
+        expected,
+    ):
+        """Test that a rate limit waits as long as Retry-After asks, up to a cap."""
+        mock_call_gpt_api.side_effect = [
+            self.rate_limit_error(mocker, {"retry-after": retry_after}),
+            ('{"content": null, "command": "ls", "error": null}', 0),
+        ]
+        assert chat_instance._generate_response([], False).command == "ls"
+        mock_sleep.assert_called_once_with(expected)
+
+    @patch("calais.chat.Chat._call_gpt_api")
+    @patch("time.sleep", return_value=None)
+    @pytest.mark.parametrize(
+        "headers", [{}, {"retry-after": "-5"}, {"retry-after": "nan"}]
+    )
+    def test_rate_limit_without_retry_after_backs_off(
+        self, mock_sleep, mock_call_gpt_api, chat_instance, mocker, headers
+    ):
+        """Test that a rate limit without a usable Retry-After backs off as usual."""
+        mock_call_gpt_api.side_effect = [
+            self.rate_limit_error(mocker, headers),
+            ('{"content": null, "command": "ls", "error": null}', 0),
+        ]
+        with patch("random.random", return_value=0.5):
+            chat_instance._generate_response([], False)
+        mock_sleep.assert_called_once_with(chat_instance.config.retry_delay)
+
+    @patch("calais.chat.Chat._call_gpt_api")
+    @patch("time.sleep", return_value=None)
+    def test_first_timeout_retries_immediately(
+        self, mock_sleep, mock_call_gpt_api, chat_instance, mocker
+    ):
+        """Test that only the first timeout is retried without waiting."""
+        mock_call_gpt_api.side_effect = [
+            APITimeoutError(request=mocker.MagicMock()),
+            APITimeoutError(request=mocker.MagicMock()),
+            ('{"content": null, "command": "ls", "error": null}', 0),
+        ]
+        with patch("random.random", return_value=0.5):
+            chat_instance._generate_response([], False)
+        assert mock_sleep.call_args_list == [mock.call(0), mock.call(2)]
@@ -1,30 +1,48 @@
 """Tests for the Client class."""
 
+from typing import Iterable, Iterator, List, Tuple
 import pytest
 
+from openai import NOT_GIVEN
 from openai.types.chat.chat_completion_chunk import (
     Choice,
     ChoiceDelta,
     ChatCompletionChunk,
 )
 
-from calais.client import IOpenAIClient
-from calais.chat import Chat
+from calais.client import EMBEDDING_MODEL, IOpenAIClient, OpenAIClient
+from calais.chat import Chat, ChatConfig
 
 # pylint: disable=redefined-outer-name
 
 
+class StubOpenAIClient(IOpenAIClient):
+    """A stub IOpenAIClient that records its calls and returns given chunks."""
+
+    def __init__(self) -> None:
+        self.chunks: List[ChatCompletionChunk] = []
+        self.calls: List[Tuple[list, float]] = []
+
+    def call_api(
+        self, messages: Iterable, timeout: float
+    ) -> Iterator[ChatCompletionChunk]:
+        """Record the call and return the chunks."""
+        self.calls.append((list(messages), timeout))
+        return iter(self.chunks)
+
+
 @pytest.fixture
-def mock_openai_client(mocker) -> IOpenAIClient:
-    """Create a mock IOpenAIClient."""
-    return mocker.create_autospec(IOpenAIClient, instance=True)
+def stub_client() -> StubOpenAIClient:
+    """Create a stub IOpenAIClient."""
+    return StubOpenAIClient()
 
 
 # TODO: Remove. This is Chat, not the client.
 @pytest.fixture
-def chat_service(mock_openai_client) -> Chat:
+def chat_service(stub_client) -> Chat:
     """Inject the mock IOpenAIClient into Chat."""
-    return Chat(mock_openai_client, 1, 1, 1, 1)
+    config = ChatConfig(retries=1, timeout=1, retry_delay=1, max_empty_chunks=1)
+    return Chat(stub_client, config)
 
 
 def make_mock_chunk(content, finish_reason=None) -> ChatCompletionChunk:
@@ -45,30 +63,29 @@ def make_mock_chunk(content, finish_reason=None) -> ChatCompletionChunk:
 
 
 class TestChat:
-    """Helper class for testing the Chat service."""
+    """Tests for calling the API through Chat with a mock IOpenAIClient."""
 
-    def test_chat_call_api_single_chunk(self, mock_openai_client, chat_service) -> None:
+    def test_chat_call_api_single_chunk(self, stub_client, chat_service) -> None:
         """Test a single chunk response."""
         mock_chunk = make_mock_chunk("single_chunk", None)
-        mock_openai_client.call_api.return_value = iter([mock_chunk])
+        stub_client.chunks = [mock_chunk]
 
         test_message = {"role": "user", "content": "Hello, single chunk!"}
         result_stream = chat_service._call_api([test_message])
+        assert stub_client.calls == [([test_message], 1)]
 
         chunk = next(result_stream)
         assert chunk.choices[0].delta.content == "single_chunk"
         assert chunk.choices[0].finish_reason is None
 
-    def test_chat_call_api_multiple_chunks(
-        self, mock_openai_client, chat_service
-    ) -> None:
+    def test_chat_call_api_multiple_chunks(self, stub_client, chat_service) -> None:
         """Test a multiple chunk response."""
         mock_chunks = [
             make_mock_chunk("chunk0"),
             make_mock_chunk("chunk1"),
             make_mock_chunk("chunk2", "stop"),
         ]
-        mock_openai_client.call_api.return_value = iter(mock_chunks)
+        stub_client.chunks = mock_chunks
 
         test_messages = [
             {"role": "system", "content": "Test system message"},
@@ -83,3 +100,52 @@ class TestChat:
         ):
             assert chunk.choices[0].delta.content == expected_content
             assert chunk.choices[0].finish_reason == expected_finish_reason
+
+
+class TestOpenAIClient:
+    """Tests for the OpenAIClient class."""
+
+    def test_call_api_passes_prompt_cache_key(self, mocker) -> None:
+        """Test that the prompt cache key and timeout are sent with the request."""
+        mocker.patch("openai.OpenAI")
+        client = OpenAIClient("key", "gpt-4", 100, 0.3, prompt_cache_key="calais")
+        client.call_api([], timeout=10)
+        kwargs = client.client.chat.completions.create.call_args.kwargs
+        assert kwargs["prompt_cache_key"] == "calais"
+        assert kwargs["timeout"] == 10
+
+    def test_call_api_omits_missing_prompt_cache_key(self, mocker) -> None:
+        """Test that no prompt cache key is sent if none was given."""
+        mocker.patch("openai.OpenAI")
+        client = OpenAIClient("key", "gpt-4", 100, 0.3)
+        client.call_api([], timeout=10)
+        kwargs = client.client.chat.completions.create.call_args.kwargs
+        assert kwargs["prompt_cache_key"] is NOT_GIVEN
+
+    def test_embed(self, mocker) -> None:
+        """Test that embed returns the embedding of the text."""
+        mocker.patch("openai.OpenAI")
+        client = OpenAIClient("key", "gpt-4", 100, 0.3)
+        create = client.client.embeddings.create
+        create.return_value.data = [mocker.MagicMock(embedding=[0.1, 0.2])]
+        assert client.embed("list files", timeout=10) == [0.1, 0.2]
+        create.assert_called_once_with(
+            model=EMBEDDING_MODEL, input="list files", timeout=10
+        )
+
+    def test_close_closes_connections(self, mocker) -> None:
+        """Test that close closes the underlying OpenAI client."""
+        mocker.patch("openai.OpenAI")
+        client = OpenAIClient("key", "gpt-4", 100, 0.3)
+        openai_client = client.client
+        client.close()
+        openai_client.close.assert_called_once()
+
+    def test_openai_client_created_on_first_use(self, mocker) -> None:
+        """Test that the OpenAI client is only created when first needed."""
+        mock_openai = mocker.patch("openai.OpenAI")
+        client = OpenAIClient("key", "gpt-4", 100, 0.3)
+        client.close()
+        mock_openai.assert_not_called()
+        assert client.client is client.client
+        mock_openai.assert_called_once_with(api_key="key")
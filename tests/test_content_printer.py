@@ -1,7 +1,15 @@
 """Tests for the ContentPrinter class."""
 
+import sys
+
 import pytest
-from calais.content_printer import ContentPrinter
+from calais.content_printer import (
+    FLUSH_INTERVAL,
+    FLUSH_SIZE,
+    ContentPrinter,
+    _failure_table,
+    _partial_marker_length,
+)
 
 
 @pytest.fixture
@@ -14,6 +22,27 @@ def printer():
 # pylint: disable=protected-access
 
 
+class TestPartialMarkerLength:
+    """Tests for the _partial_marker_length function."""
+
+    @pytest.mark.parametrize(
+        "text, marker, expected",
+        [
+            ("", '",', 0),
+            ("content", '",', 0),
+            ('content "', '",', 1),
+            ('"', '",', 1),
+            ('content ",', '",', 0),
+            ("abcab", "abcabd", 5),
+            ("xaab", "aabaab", 3),
+            ("aaa", "aab", 2),
+        ],
+    )
+    def test_partial_marker_length(self, text, marker, expected):
+        """Test the length of a marker prefix at the end of the text."""
+        assert _partial_marker_length(text, marker, _failure_table(marker)) == expected
+
+
 class TestInitMethod:
     """Tests for the __init__ method."""
 
@@ -32,15 +61,30 @@ class TestPrintChunkMethod:
         printer.print_chunk("test chunk")
         assert printer.accumulated_chunk == "test chunk"
 
+    def test_print_chunk_accumulates_multiple_chunks(self, printer):
+        """Test that pending chunks are joined when the buffer is read."""
+        printer.print_chunk("test ")
+        printer.print_chunk("chunk")
+        assert printer.accumulated_chunk == "test chunk"
+        assert printer._pending_chunks == ["test chunk"]
+
     def test_print_chunk_calls_start_printing_content_if_not_printing(
         self, printer, mocker
     ):
         """Test that print_chunk calls _start_printing_content if not printing."""
         printer.printing_contents = False
         mocker.patch.object(printer, "_start_printing_content")
-        printer.print_chunk("test chunk")
+        printer.print_chunk('test "chunk')
         printer._start_printing_content.assert_called_once()
 
+    def test_print_chunk_skips_search_without_quote(self, printer, mocker):
+        """Test that a chunk without a quote can't start the contents."""
+        mocker.patch.object(printer, "_start_printing_content")
+        printer.print_chunk('{"content')
+        printer.print_chunk(": ")
+        printer._start_printing_content.assert_called_once()
+        assert printer.accumulated_chunk == '{"content: '
+
     def test_print_chunk_calls_continue_printing_content_if_printing(
         self, printer, mocker
     ):
@@ -54,19 +98,92 @@ class TestPrintChunkMethod:
 class TestPrintUnescapedChunk:
     """Tests for the print_unescaped_chunk function."""
 
-    test_data = [
-        ("Hello\\nWorld", "Hello\nWorld"),
-        ("Hello\\tWorld", "Hello\tWorld"),
-        ("Hello \\'World\\'", "Hello 'World'"),
-        ("Hello\\\\World", "Hello\\World"),
-    ]
-
-    def test_print_unescaped_chunk_unescapes_and_prints_content(self, printer, capsys):
+    @pytest.mark.parametrize(
+        "chunk_text, expected_output",
+        [
+            ("Hello\\nWorld", "Hello\nWorld"),
+            ("Hello\\tWorld", "Hello\tWorld"),
+            ("Hello \\'World\\'", "Hello 'World'"),
+            ("Hello\\\\World", "Hello\\World"),
+            ("café \\u00e9 \\ud83d\\ude00", "café é \U0001f600"),
+            ('Say \\"hi\\"', 'Say "hi"'),
+        ],
+    )
+    def test_print_unescaped_chunk_unescapes_and_prints_content(
+        self, printer, capsys, chunk_text, expected_output
+    ):
         """Test that print_unescaped_chunk unescapes the content and prints it."""
-        for chunk_text, expected_output in self.test_data:
+        printer._print_unescaped_chunk(chunk_text)
+        captured = capsys.readouterr()
+        assert captured.out == expected_output
+
+    @pytest.mark.parametrize(
+        "chunks, expected_output",
+        [
+            (["Hello\\", "nWorld"], "Hello\nWorld"),
+            (["caf\\u00", "e9!"], "caf\u00e9!"),
+            (["Hello\\\\", "World"], "Hello\\World"),
+            (["\\ud83d", "\\ude00"], "\U0001f600"),
+            (["\\ud83d\\u", "de00"], "\U0001f600"),
+            (["\\ud83d\\ude0", "0"], "\U0001f600"),
+            (["\\ud83d\\", "ude00"], "\U0001f600"),
+        ],
+    )
+    def test_print_unescaped_chunk_joins_split_escapes(
+        self, printer, capsys, chunks, expected_output
+    ):
+        """Test that an escape sequence split across chunks is decoded whole."""
+        for chunk_text in chunks:
             printer._print_unescaped_chunk(chunk_text)
-            captured = capsys.readouterr()
-            assert captured.out == expected_output
+        captured = capsys.readouterr()
+        assert captured.out == expected_output
+
+    def test_finish_prints_held_back_escape(self, printer, capsys):
+        """Test that finish prints an incomplete escape that never completed."""
+        printer._print_unescaped_chunk("Hello\\")
+        printer.finish()
+        captured = capsys.readouterr()
+        assert captured.out == "Hello\\\n"
+
+
+class TestFlushing:
+    """Tests for batching flushes of the printed output."""
+
+    @pytest.fixture(autouse=True)
+    def frozen_clock(self, mocker):
+        """Stop the clock so that only the flush size triggers a flush."""
+        return mocker.patch("time.monotonic", return_value=0.0)
+
+    def test_short_chunks_are_not_flushed(self, printer, capsys, mocker):
+        """Test that short chunks are written without flushing."""
+        flush = mocker.patch.object(sys.stdout, "flush")
+        printer._print_unescaped_chunk("Hello")
+        printer._print_unescaped_chunk(" World")
+        flush.assert_not_called()
+        assert capsys.readouterr().out == "Hello World"
+
+    def test_flushes_after_flush_size(self, printer, mocker):
+        """Test that the output is flushed once enough text is waiting."""
+        flush = mocker.patch.object(sys.stdout, "flush")
+        printer._print_unescaped_chunk("x" * (FLUSH_SIZE - 1))
+        flush.assert_not_called()
+        printer._print_unescaped_chunk("x")
+        flush.assert_called_once()
+
+    def test_flushes_after_flush_interval(self, printer, frozen_clock, mocker):
+        """Test that the output is flushed once enough time has passed."""
+        flush = mocker.patch.object(sys.stdout, "flush")
+        frozen_clock.return_value = FLUSH_INTERVAL
+        printer._print_unescaped_chunk("Hello")
+        flush.assert_called_once()
+
+    def test_flushes_at_end_of_contents(self, printer, mocker):
+        """Test that the output is flushed when the end marker is found."""
+        flush = mocker.patch.object(sys.stdout, "flush")
+        printer.print_chunk('"content": "Hello')
+        flush.assert_not_called()
+        printer.print_chunk('",')
+        flush.assert_called_once()
 
 
 class TestStartPrintingContentMethod:
@@ -174,3 +291,14 @@ class TestPrintChunkWithSplitMarkers:
         assert captured.out == "content text "
         assert printer.printing_contents is False
         assert printer.accumulated_chunk == "\n suffix"
+
+    def test_print_chunk_with_end_marker_split_after_start_marker(
+        self, printer, capsys
+    ):
+        """Test that a partial end marker in the start marker's chunk is held."""
+        printer.print_chunk('{"content": "hi there"')
+        printer.print_chunk(', "command": null}')
+        captured = capsys.readouterr()
+        assert captured.out == "hi there"
+        assert printer.printing_contents is False
+        assert printer.accumulated_chunk == ' "command": null}'
@@ -1,16 +1,28 @@
 """Tests for the main module."""
 
 import re
+import subprocess
+import sys
+from pathlib import Path
 from unittest.mock import patch, MagicMock
 import pytest
 
 import calais.main
+from calais.response import Response
+
+# The subprocesses run here so that they import this checkout of calais.
+REPO_ROOT = Path(__file__).resolve().parents[1]
 
 
 # Group tests for review_command function
 class TestReviewCommand:
     """Test the review_command function."""
 
+    @pytest.fixture(autouse=True)
+    def mock_exit(self, mocker) -> MagicMock:
+        """Fixture to patch sys.exit for every test."""
+        return mocker.patch("sys.exit")
+
     def test_review_command_with_cleaning(self) -> None:
         """Test review_command with a command that has extra spaces."""
         command = "ls  -la"
@@ -41,38 +53,252 @@ class TestReviewCommand:
             " format c: /q ",
         ],
     )
-    def test_review_command_with_unsafe_command(self, command) -> None:
+    def test_review_command_with_unsafe_command(self, command, mock_exit) -> None:
         """Test review_command with various unsafe commands."""
-        with patch("sys.exit") as mock_exit:
-            calais.main.review_command(command)
-            mock_exit.assert_called_once_with(1)
+        calais.main.review_command(command)
+        mock_exit.assert_called_once_with(1)
 
 
 class TestCheckInput:
     """Test the check_input function."""
 
     @pytest.fixture
-    def mock_match(self) -> re.Match:
-        """Fixture to create a mock re.Match object."""
-        match = MagicMock(spec=re.Match)
-        match.group.return_value = "test_pattern"
+    def match(self) -> re.Match:
+        """Fixture to create a placeholder match."""
+        match = calais.main.PLACEHOLDER_PATTERN.search("echo <test_pattern>")
+        assert match is not None
         return match
 
-    def test_check_input_safe(self, mock_match) -> None:
+    @pytest.fixture
+    def mock_input(self, mocker) -> MagicMock:
+        """Fixture to patch the user's input."""
+        return mocker.patch("builtins.input")
+
+    @pytest.fixture(autouse=True)
+    def mock_exit(self, mocker) -> MagicMock:
+        """Fixture to patch sys.exit for every test."""
+        return mocker.patch("sys.exit")
+
+    def test_check_input_safe(self, match, mock_input, mock_exit) -> None:
         """Test check_input with safe user input."""
-        with patch("builtins.input", return_value="safe_input") as mock_input:
-            result = calais.main.check_input(mock_match)
-            mock_input.assert_called_once_with("Enter the value for test_pattern: ")
-            assert result == "safe_input"
-
-    def test_check_input_unsafe_root(self, mock_match) -> None:
-        """Test check_input with unsafe user input targeting root directory."""
-        with patch("builtins.input", return_value="/"), patch("sys.exit") as mock_exit:
-            calais.main.check_input(mock_match)
-            mock_exit.assert_called_once_with(1)
-
-    def test_check_input_unsafe_root_wildcard(self, mock_match) -> None:
-        """Test check_input with unsafe user input targeting root directory with wildcard."""
-        with patch("builtins.input", return_value="/*"), patch("sys.exit") as mock_exit:
-            calais.main.check_input(mock_match)
-            mock_exit.assert_called_once_with(1)
+        mock_input.return_value = "safe_input"
+        result = calais.main.check_input(match)
+        mock_input.assert_called_once_with("Enter the value for <test_pattern>: ")
+        assert result == "safe_input"
+        mock_exit.assert_not_called()
+
+    @pytest.mark.parametrize("user_input", ["/", "/*", " / "])
+    def test_check_input_unsafe_root(
+        self, match, mock_input, mock_exit, user_input
+    ) -> None:
+        """Test check_input with unsafe user input targeting the root directory."""
+        mock_input.return_value = user_input
+        calais.main.check_input(match)
+        mock_exit.assert_called_once_with(1)
+
+
+class TestProcessCommand:
+    """Test the process_command function."""
+
+    def test_repeated_placeholder_asked_once(self) -> None:
+        """Test that each distinct placeholder is asked for once, in order."""
+        with patch("builtins.input", side_effect=["src", "*.py"]) as mock_input:
+            command = calais.main.process_command(
+                "find <dir> -name <pattern> && ls <dir>"
+            )
+        assert command == "find src -name *.py && ls src"
+        assert mock_input.call_count == 2
+
+    def test_mismatched_brackets(self) -> None:
+        """Test that mismatched angle brackets raise a ValueError."""
+        with pytest.raises(ValueError):
+            calais.main.process_command("echo <name")
+
+
+class TestDoCommand:
+    """Test the do_command function."""
+
+    @pytest.fixture
+    def response(self) -> Response:
+        """Fixture to create a command response."""
+        return Response(None, "ls -l", None)
+
+    @pytest.mark.parametrize("choice", ["q", "quit", " EXIT "])
+    def test_do_command_quit(self, response, choice) -> None:
+        """Test do_command exits on a quit choice."""
+        with patch("builtins.input", return_value=choice), patch(
+            "sys.exit", side_effect=SystemExit
+        ) as mock_exit:
+            with pytest.raises(SystemExit):
+                calais.main.do_command(response)
+            mock_exit.assert_called_once_with(0)
+
+    def test_do_command_run(self, response) -> None:
+        """Test do_command replaces the process with a shell on POSIX."""
+        with patch("builtins.input", return_value="r"), patch(
+            "os.name", "posix"
+        ), patch("os.execv", side_effect=SystemExit) as mock_execv:
+            with pytest.raises(SystemExit):
+                calais.main.do_command(response)
+        mock_execv.assert_called_once_with("/bin/sh", ["sh", "-c", "ls -l"])
+
+    def test_do_command_run_without_exec(self, response) -> None:
+        """Test do_command runs the command in a subprocess elsewhere."""
+        with patch("builtins.input", return_value="r"), patch("os.name", "nt"), patch(
+            "subprocess.run"
+        ) as mock_run, patch("sys.exit", side_effect=SystemExit) as mock_exit:
+            with pytest.raises(SystemExit):
+                calais.main.do_command(response)
+        mock_run.assert_called_once_with("ls -l", shell=True, check=True)
+        mock_exit.assert_called_once_with(0)
+
+    @pytest.mark.parametrize("choice", ["e", "ex", "Explain"])
+    def test_do_command_explain(self, response, choice) -> None:
+        """Test do_command returns an explain prompt."""
+        with patch("builtins.input", return_value=choice):
+            user_prompt = calais.main.do_command(response)
+        assert user_prompt.startswith("Explain the command `ls -l`.")
+
+    def test_do_command_continue_chatting(self, response) -> None:
+        """Test do_command returns a new prompt for any other choice."""
+        with patch("builtins.input", side_effect=["c", "use long format"]):
+            assert calais.main.do_command(response) == "use long format"
+
+
+class TestDoContentPrompt:
+    """Test the do_content_prompt function."""
+
+    @pytest.mark.parametrize("choice", ["", "q", "Quit", " exit"])
+    def test_do_content_prompt_quit(self, choice) -> None:
+        """Test do_content_prompt exits on a quit choice."""
+        with patch("builtins.input", return_value=choice), patch(
+            "sys.exit", side_effect=SystemExit
+        ) as mock_exit:
+            with pytest.raises(SystemExit):
+                calais.main.do_content_prompt()
+            mock_exit.assert_called_once_with(0)
+
+    def test_do_content_prompt_continue_chatting(self) -> None:
+        """Test do_content_prompt returns the new prompt."""
+        with patch("builtins.input", return_value="translate"):
+            assert calais.main.do_content_prompt() == "translate"
+
+
+class TestConverse:
+    """Test the converse function."""
+
+    @pytest.mark.parametrize(
+        "user_prompt", ["rm -rf /", "run  RM -RF /  now", "chmod -R 777 /"]
+    )
+    def test_converse_rejects_unsafe_prompt_without_api_call(
+        self, user_prompt, capsys
+    ) -> None:
+        """Test converse rejects an unsafe prompt and asks for another."""
+        gpt = MagicMock()
+        with patch("builtins.input", return_value="q") as mock_input, patch(
+            "sys.exit", side_effect=SystemExit
+        ) as mock_exit:
+            with pytest.raises(SystemExit):
+                calais.main.converse(gpt, user_prompt)
+            mock_exit.assert_called_once_with(0)
+        mock_input.assert_called_once()
+        gpt.call_gpt4.assert_not_called()
+        out = capsys.readouterr().out
+        assert calais.main.UNSAFE_COMMAND_ERROR in out
+        assert "GPT-4" not in out
+
+    def test_converse_sends_new_prompt_after_unsafe_one(self) -> None:
+        """Test that the session continues with the prompt given instead."""
+        gpt = MagicMock()
+        gpt.call_gpt4.return_value = Response(None, None, "stop")
+        with patch("builtins.input", return_value="list files"), patch(
+            "sys.exit", side_effect=SystemExit
+        ):
+            with pytest.raises(SystemExit):
+                calais.main.converse(gpt, "rm -rf /")
+        gpt.call_gpt4.assert_called_once_with("list files", True)
+
+    @pytest.mark.parametrize(
+        "user_prompt",
+        ["show my history | grep ssh", "empty app.log with truncate -s 0"],
+    )
+    def test_check_prompt_allows_harmless_prompts(self, user_prompt) -> None:
+        """Test that prompts matching only command-level strings are sent."""
+        with patch("builtins.input") as mock_input:
+            assert calais.main.check_prompt(user_prompt) == user_prompt
+        mock_input.assert_not_called()
+
+    def test_explain_prompt_is_not_checked(self) -> None:
+        """Test that explaining a reviewed command doesn't reject the prompt."""
+        gpt = MagicMock()
+        gpt.call_gpt4.side_effect = [
+            Response(None, "echo RM -RF /tmp", None),
+            Response(None, None, "stop"),
+        ]
+        with patch("builtins.input", return_value="e"), patch(
+            "sys.exit", side_effect=SystemExit
+        ):
+            with pytest.raises(SystemExit):
+                calais.main.converse(gpt, "say it loudly")
+        explain_prompt = gpt.call_gpt4.call_args_list[1].args[0]
+        assert explain_prompt.startswith("Explain the command `echo RM -RF /tmp`.")
+
+
+class TestInitializeGpt:
+    """Test the initialize_gpt function."""
+
+    def test_system_prompt_is_stable_prefix(self, monkeypatch) -> None:
+        """Test that the system prompt is sent unchanged, before the OS."""
+        monkeypatch.setenv("OPENAI_API_KEY", "key")
+        monkeypatch.delenv("CALAIS_CACHE", raising=False)
+        monkeypatch.delenv("CALAIS_SEMANTIC_CACHE", raising=False)
+        gpt = calais.main.initialize_gpt(calais.main.COMMAND_SYSTEM_PROMPT)
+        prompt = gpt.conversation[0]["content"]
+        assert prompt == calais.main.COMMAND_SYSTEM_PROMPT
+        assert prompt == prompt.strip()
+        assert all(line == line.rstrip() for line in prompt.splitlines())
+        assert gpt.conversation[1]["content"].startswith("The OS is ")
+
+
+class TestMain:
+    """Test the main function."""
+
+    @pytest.mark.parametrize(
+        "argv, use_cache",
+        [
+            (["ai", "list", "files"], True),
+            (["ai", "--no-cache", "list", "files"], False),
+        ],
+    )
+    def test_main_no_cache_flag(self, argv, use_cache) -> None:
+        """Test that --no-cache disables the cache and is not sent to GPT-4."""
+        with patch("sys.argv", argv), patch(
+            "calais.main.initialize_gpt"
+        ) as mock_initialize, patch("calais.main.converse") as mock_converse:
+            calais.main.main()
+        mock_initialize.assert_called_once_with(
+            calais.main.COMMAND_SYSTEM_PROMPT, use_cache
+        )
+        mock_converse.assert_called_once_with(
+            mock_initialize.return_value, "list files"
+        )
+
+
+class TestImports:
+    """Test what importing the main module loads."""
+
+    @pytest.mark.parametrize("module", ["openai", "subprocess", "typing_extensions"])
+    def test_not_imported_at_startup(self, module) -> None:
+        """Test that slow imports are only made when they're needed."""
+        result = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                f"import sys, calais.main; print({module!r} in sys.modules)",
+            ],
+            capture_output=True,
+            check=True,
+            cwd=REPO_ROOT,
+            text=True,
+        )
+        assert result.stdout.strip() == "False"
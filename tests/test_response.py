@@ -26,6 +26,13 @@ class TestResponse:
         assert response.command is None
         assert response.error == "This is an error."
 
+    def test_slots(self) -> None:
+        """Test that responses don't carry a per-instance __dict__."""
+        response = Response(None, "ls", None)
+        assert not hasattr(response, "__dict__")
+        with pytest.raises(AttributeError):
+            response.extra = "value"  # type: ignore[attr-defined]
+
     def test_to_json(self) -> None:
         """Test the serialization of Response objects into JSON strings."""
         test_cases: Dict[str, Dict[str, Any]] = {
@@ -0,0 +1,91 @@
+"""Tests for the SemanticCache class."""
+
+import pytest
+
+from calais.response import Response
+from calais.semantic_cache import SemanticCache, dot, normalize
+
+# pylint: disable=redefined-outer-name
+
+EMBEDDINGS = {
+    "list text files": [1.0, 0.0, 0.0],
+    "show all .txt files": [0.99, 0.1, 0.0],
+    "delete text files": [0.0, 1.0, 0.0],
+}
+
+CONTEXT = [{"role": "system", "content": "You are a shell."}]
+
+
+@pytest.fixture
+def embed(mocker):
+    """Create a mock embedding function that looks up EMBEDDINGS."""
+    return mocker.MagicMock(side_effect=EMBEDDINGS.__getitem__)
+
+
+@pytest.fixture
+def cache(tmp_path, embed) -> SemanticCache:
+    """Create a SemanticCache in a temporary directory."""
+    return SemanticCache(str(tmp_path / "semantic.db"), "gpt-4", 0.3, embed)
+
+
+def test_normalize() -> None:
+    """Test that vectors are scaled to unit length and zero is unchanged."""
+    assert normalize([3.0, 4.0]) == pytest.approx([0.6, 0.8])
+    assert normalize([0.0, 0.0]) == [0.0, 0.0]
+
+
+def test_dot() -> None:
+    """Test the dot product of unit vectors is their cosine similarity."""
+    assert dot(normalize([1.0, 2.0]), normalize([2.0, 4.0])) == pytest.approx(1.0)
+    assert dot([1.0, 0.0], [0.0, 1.0]) == 0.0
+
+
+class TestGetSet:
+    """Test the get and set methods of the SemanticCache class."""
+
+    def test_similar_prompt_hits(self, cache) -> None:
+        """Test that a paraphrased prompt returns the stored response."""
+        response = Response(None, "ls *.txt", None)
+        cache.set(CONTEXT, "list text files", response)
+        assert cache.get(CONTEXT, "show all .txt files") == (
+            "list text files",
+            response,
+        )
+
+    def test_dissimilar_prompt_misses(self, cache) -> None:
+        """Test that a prompt with a different meaning isn't answered."""
+        cache.set(CONTEXT, "list text files", Response(None, "ls *.txt", None))
+        assert cache.get(CONTEXT, "delete text files") is None
+
+    def test_different_context_misses(self, cache) -> None:
+        """Test that responses aren't reused after a different conversation."""
+        cache.set(CONTEXT, "list text files", Response(None, "ls *.txt", None))
+        other = [{"role": "system", "content": "You are a poet."}]
+        assert cache.get(other, "list text files") is None
+
+    def test_empty_cache_does_not_embed(self, cache, embed) -> None:
+        """Test that the prompt isn't embedded if nothing could match it."""
+        assert cache.get(CONTEXT, "list text files") is None
+        embed.assert_not_called()
+
+    def test_embeddings_are_reused(self, cache, embed) -> None:
+        """Test that the same prompt is only embedded once."""
+        cache.set(CONTEXT, "list text files", Response(None, "ls *.txt", None))
+        cache.get(CONTEXT, "list text files")
+        embed.assert_called_once_with("list text files")
+
+    def test_expires_old_responses(self, cache, mocker) -> None:
+        """Test that a response older than max_age is not returned."""
+        mock_time = mocker.patch("time.time", return_value=0.0)
+        cache.set(CONTEXT, "list text files", Response(None, "ls *.txt", None))
+        mock_time.return_value = cache.max_age + 1
+        assert cache.get(CONTEXT, "list text files") is None
+
+    def test_evicts_oldest_beyond_max_entries(self, tmp_path, embed) -> None:
+        """Test that only the newest max_entries prompts are kept."""
+        cache = SemanticCache(
+            str(tmp_path / "semantic.db"), "gpt-4", 0.3, embed, max_entries=1
+        )
+        cache.set(CONTEXT, "list text files", Response(None, "ls *.txt", None))
+        cache.set(CONTEXT, "delete text files", Response(None, "rm *.txt", None))
+        assert cache.get(CONTEXT, "list text files") is None